@@ -0,0 +1,62 @@
+import datetime
+import os
+import sys
+import timeit
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'finance')))
+
+from backend import Connection, Transaction # noqa
+from backend.db import _FETCH_TX # noqa
+
+
+ROWS = 10000
+CALLS = 5000
+
+
+def seed(db):
+    start = datetime.datetime(2015, 1, 1)
+    db.store_transactions(
+        Transaction(None, start + datetime.timedelta(hours=i), 'Transaction {}'.format(i), i)
+        for i in range(ROWS))
+
+
+def fresh_cursor_fetch(db, tid):
+    # The pre-existing per-call path: a new cursor for every query. Both cursor paths
+    # go straight to the driver, past the result cache and its data_version check.
+    with db._safe_cursor() as c:
+        return c.execute(_FETCH_TX, (tid,)).fetchone()
+
+
+def reused_cursor_fetch(db, tid):
+    return db._reusable_cursor(_FETCH_TX).execute(_FETCH_TX, (tid,)).fetchone()
+
+
+def report(name, seconds):
+    print('{:<50} {:>8.2f} us/call'.format(name, seconds * 1000000 / CALLS))
+
+
+def main():
+    # 128 is the driver's own default, and 0 turns its statement cache off.
+    for statement_cache_size in (0, Connection.statement_cache_size):
+        db = Connection(':memory:', 'benchmark')
+        db.statement_cache_size = statement_cache_size
+        db.connect()
+        seed(db)
+        label = 'statement cache {}'.format(statement_cache_size)
+        report('fetch by id (fresh cursor, {})'.format(label),
+               timeit.timeit(lambda: fresh_cursor_fetch(db, ROWS // 2), number=CALLS))
+        report('fetch by id (reused cursor, {})'.format(label),
+               timeit.timeit(lambda: reused_cursor_fetch(db, ROWS // 2), number=CALLS))
+        db.close()
+
+    db = Connection(':memory:', 'benchmark')
+    db.connect()
+    seed(db)
+    tx = db.fetch_transaction(ROWS // 2)
+    report('has_transaction (reused cursor)', timeit.timeit(lambda: db.has_transaction(tx), number=CALLS))
+    report('tag <id> round trip', timeit.timeit(lambda: db.store_transaction(db.fetch_transaction(ROWS // 2)),
+                                                number=CALLS))
+    db.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,4 +1,12 @@
+import datetime
+
+
 class Transaction(object):
+    # Slotted, and stored rows keep their raw epoch until the timestamp is read, so
+    # that iterating large views doesn't pay for a __dict__ and a datetime per row.
+    __slots__ = ('tid', '_timestamp', '_epoch', 'description', 'amount_pence',
+                 'category_1', 'category_2', 'category_3', 'notes')
+
     def __init__(self, tid, timestamp, description, amount_pence,
                  category_1=None, category_2=None, category_3=None, notes=None):
         self.tid = tid
@@ -9,3 +17,41 @@ class Transaction(object):
         self.category_2 = category_2
         self.category_3 = category_3
         self.notes = notes
+
+    @classmethod
+    def from_row(cls, row):
+        tx = cls.__new__(cls)
+        (tx.tid, tx._epoch, tx.description, tx.amount_pence,
+         tx.category_1, tx.category_2, tx.category_3, tx.notes) = row
+        tx._timestamp = None
+        return tx
+
+    def as_row(self):
+        return (self.tid, self.epoch, self.description, self.amount_pence,
+                self.category_1, self.category_2, self.category_3, self.notes)
+
+    @property
+    def timestamp(self):
+        if self._timestamp is None and self._epoch is not None:
+            self._timestamp = _epoch_to_datetime(self._epoch)
+        return self._timestamp
+
+    @timestamp.setter
+    def timestamp(self, timestamp):
+        self._timestamp = timestamp
+        self._epoch = None
+
+    @property
+    def epoch(self):
+        if self._epoch is None and self._timestamp is not None:
+            self._epoch = _datetime_to_epoch(self._timestamp)
+        return self._epoch
+
+
+def _datetime_to_epoch(dt):
+    epoch = datetime.datetime.utcfromtimestamp(0)
+    return int((dt - epoch).total_seconds() * 1000000)
+
+
+def _epoch_to_datetime(dt):
+    return datetime.datetime.utcfromtimestamp(dt / 1000000)
@@ -0,0 +1,67 @@
+from collections import OrderedDict
+
+
+# Rough cost of holding one value of a result, on top of the text it carries.
+_VALUE_OVERHEAD = 48
+
+
+class ResultCache(object):
+    # Bounded LRU of query results. Each entry is stamped with the connection's data
+    # generation when stored, and is treated as a miss once the generation moves on.
+    # Sizes are estimated from the text in each row, so long notes count for more.
+    def __init__(self, max_entries, max_bytes):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.size = 0
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, generation):
+        entry = self._entries.get(key)
+        if entry is None or entry[0] != generation:
+            self.misses += 1
+            if entry is not None:
+                self._evict(key)
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def peek(self, key, generation):
+        # As get(), without counting towards the statistics or reordering entries.
+        entry = self._entries.get(key)
+        return entry[1] if entry is not None and entry[0] == generation else None
+
+    def put(self, key, generation, rows):
+        if self.max_entries == 0:
+            return
+        size = estimate_size(rows)
+        if size > self.max_bytes:
+            return
+        if key in self._entries:
+            self._evict(key)
+        self._entries[key] = (generation, rows, size)
+        self.size += size
+        while len(self._entries) > self.max_entries or self.size > self.max_bytes:
+            self._evict(next(iter(self._entries)))
+
+    def clear(self):
+        self._entries.clear()
+        self.size = 0
+
+    def describe(self):
+        return 'Result cache: {} hits, {} misses, {} entries, {} of {} KiB'.format(
+            self.hits, self.misses, len(self._entries), self.size // 1024, self.max_bytes // 1024)
+
+    def _evict(self, key):
+        _, _, size = self._entries.pop(key)
+        self.size -= size
+
+
+def estimate_size(rows):
+    return sum(_VALUE_OVERHEAD * len(row) + sum(len(value) for value in row if isinstance(value, (str, bytes)))
+               for row in rows)
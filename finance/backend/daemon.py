@@ -0,0 +1,344 @@
+import hashlib
+import json
+import logging
+import os
+import socket
+import socketserver
+import stat
+import struct
+import tempfile
+from .api import Transaction, _datetime_to_epoch, _epoch_to_datetime
+from .db import Connection
+
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_IDLE_TIMEOUT = 30 * 60
+# Seconds to wait for the daemon: checking whether it is there, and serving a request.
+PROBE_TIMEOUT = 2
+REQUEST_TIMEOUT = 5 * 60
+
+
+def socket_path(db_file):
+    # One socket per database file, inside a directory only the current user can enter.
+    # Only the daemon creates the directory; clients just look for it.
+    runtime_dir = os.environ.get('XDG_RUNTIME_DIR') or tempfile.gettempdir()
+    socket_dir = os.path.join(runtime_dir, 'finance-{}'.format(os.getuid()))
+    db_hash = hashlib.sha1(os.path.abspath(db_file).encode('utf-8')).hexdigest()[:16]
+    return os.path.join(socket_dir, db_hash + '.sock')
+
+
+def is_running(db_file):
+    try:
+        return _call(socket_path(db_file), 'ping', (), PROBE_TIMEOUT)['result']
+    except (OSError, DaemonError):
+        return False
+
+
+def lock(db_file):
+    try:
+        _call(socket_path(db_file), 'lock', (), PROBE_TIMEOUT)
+        return True
+    except (OSError, DaemonError):
+        return False
+
+
+def _is_private_dir(path):
+    try:
+        st = os.lstat(path)
+    except OSError:
+        return False
+    return stat.S_ISDIR(st.st_mode) and st.st_uid == os.getuid() and stat.S_IMODE(st.st_mode) == 0o700
+
+
+def _is_listening(path):
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(PROBE_TIMEOUT)
+        try:
+            sock.connect(path)
+        except (ConnectionRefusedError, FileNotFoundError):
+            return False
+        except socket.timeout:
+            # Something is there, if too busy to accept.
+            pass
+        return True
+
+
+def _call(path, method, args, timeout=REQUEST_TIMEOUT):
+    # Refuse sockets in a directory someone else could have put them in.
+    if not _is_private_dir(os.path.dirname(path)):
+        raise DaemonGone("No private daemon directory at '{}'".format(os.path.dirname(path)))
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(timeout)
+        sock.connect(path)
+        request = json.dumps({'method': method, 'args': list(args)}) + '\n'
+        sock.sendall(request.encode('utf-8'))
+        with sock.makefile('rb') as f:
+            line = f.readline()
+    if len(line) == 0:
+        raise DaemonGone('Daemon closed the connection without responding')
+    response = json.loads(line.decode('utf-8'))
+    if 'error' in response:
+        error = _REMOTE_ERRORS.get(response['type'], DaemonError)
+        raise error('{}: {}'.format(response['type'], response['error']))
+    return response
+
+
+class DaemonError(Exception):
+    pass
+
+
+class DaemonGone(DaemonError):
+    # The daemon couldn't be reached, e.g. because it has locked since it was last used.
+    pass
+
+
+# Errors from a bad request, raised again as themselves so that callers handle them
+# as they would with a local Connection.
+_REMOTE_ERRORS = {cls.__name__: cls for cls in (ValueError, TypeError, KeyError, IndexError)}
+
+
+class Daemon(socketserver.UnixStreamServer):
+    # Holds one unlocked Connection and serves requests from the same user, one at a
+    # time, until it is locked or has been idle for idle_timeout seconds.
+    def __init__(self, db, path, idle_timeout=DEFAULT_IDLE_TIMEOUT):
+        socket_dir = os.path.dirname(path)
+        os.makedirs(socket_dir, mode=0o700, exist_ok=True)
+        if os.lstat(socket_dir).st_uid == os.getuid():
+            os.chmod(socket_dir, 0o700)
+        if not _is_private_dir(socket_dir):
+            raise DaemonError("'{}' is not a directory private to this user".format(socket_dir))
+        if os.path.exists(path):
+            if _is_listening(path):
+                raise DaemonError("A daemon is already serving '{}'".format(path))
+            # Left behind by a daemon that didn't shut down cleanly.
+            os.remove(path)
+        self.db = db
+        self.path = path
+        self.timeout = idle_timeout
+        self.running = True
+        socketserver.UnixStreamServer.__init__(self, path, _RequestHandler)
+        os.chmod(path, 0o600)
+
+    def serve(self):
+        logger.info("Finance daemon serving '%s'", self.path)
+        try:
+            while self.running:
+                self.handle_request()
+        finally:
+            logger.info("Finance daemon locking and shutting down")
+            self.server_close()
+            if os.path.exists(self.path):
+                os.remove(self.path)
+            self.db.close()
+
+    def handle_timeout(self):
+        logger.info("Finance daemon idle for %d seconds", self.timeout)
+        self.running = False
+
+    def dispatch(self, method, args):
+        handler = getattr(self, '_rpc_' + method, None)
+        if handler is None:
+            raise ValueError('Unknown method "{}"'.format(method))
+        return handler(*args)
+
+    def _rpc_ping(self):
+        return True
+
+    def _rpc_lock(self):
+        self.running = False
+        return True
+
+    def _rpc_info(self):
+        return {'has_fulltext_index': self.db.has_fulltext_index}
+
+    def _rpc_store_transactions(self, rows):
+        return list(self.db.store_transactions(Transaction.from_row(row) for row in rows))
+
+    def _rpc_store_transaction(self, row):
+        tx = Transaction.from_row(row)
+        self.db.store_transaction(tx)
+        return tx.tid
+
+    def _rpc_fetch_rows(self, condition, params, order_by, limit, offset=0):
+        return [tx.as_row() for tx in self.db.fetch_transactions(condition, params, order_by, limit, offset)]
+
+    def _rpc_fetch_transaction(self, tid):
+        tx = self.db.fetch_transaction(tid)
+        return None if tx is None else tx.as_row()
+
+    def _rpc_has_transaction(self, row):
+        return self.db.has_transaction(Transaction.from_row(row))
+
+    def _rpc_count_transactions(self, condition, params):
+        return self.db.count_transactions(condition, params)
+
+    def _rpc_aggregate(self, condition, params, level, aggregates):
+        return self.db.aggregate(condition, params, level, aggregates)
+
+    def _rpc_extremum(self, condition, params, func, field):
+        value = self.db.extremum(condition, params, func, field)
+        if field == 'timestamp' and value is not None:
+            value = _datetime_to_epoch(value)
+        return value
+
+    def _rpc_explain(self, condition, params, order_by, limit):
+        return self.db.explain(condition, params, order_by, limit)
+
+    def _rpc_select_raw(self, query, params):
+        return self.db.select_raw(query, params)
+
+    def _rpc_update_categories(self, condition, params, categories):
+        return self.db.update_categories(condition, params, categories)
+
+    def _rpc_monthly_aggregate(self, month, level, aggregates):
+        return self.db.monthly_aggregate(month, level, aggregates)
+
+    def _rpc_monthly_totals(self):
+        return self.db.monthly_totals()
+
+    def _rpc_rebuild_monthly_totals(self):
+        return self.db.rebuild_monthly_totals()
+
+    def _rpc_backup(self, path):
+        self.db.backup(path)
+
+    def _rpc_get_layout(self, key):
+        return self.db.get_layout(key)
+
+    def _rpc_store_layout(self, key, rows):
+        self.db.store_layout(key, rows)
+
+
+class _RequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        if not self._is_same_user():
+            logger.warning("Rejected daemon connection from another user")
+            return
+
+        request = json.loads(self.rfile.readline().decode('utf-8'))
+        try:
+            response = {'result': self.server.dispatch(request['method'], request['args'])}
+        except Exception as e:
+            logger.exception("Daemon request '%s' failed", request['method'])
+            response = {'error': str(e), 'type': e.__class__.__name__}
+        response['generation'] = self.server.db.generation
+        self.wfile.write(json.dumps(response).encode('utf-8') + b'\n')
+
+    def _is_same_user(self):
+        # The socket's directory and mode already restrict access; where the platform
+        # can report the peer's credentials, check them as well.
+        if not hasattr(socket, 'SO_PEERCRED'):
+            return True
+        creds = self.request.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize('3i'))
+        _, uid, _ = struct.unpack('3i', creds)
+        return uid == os.getuid()
+
+
+class RemoteConnection(Connection):
+    # Stands in for a Connection by forwarding each query to a running daemon, so that
+    # Views and commands work unchanged without unlocking the database again.
+    # Rows fetched from the daemon per request when iterating transactions.
+    remote_page_size = 2000
+
+    def __init__(self, path):
+        Connection.__init__(self, path, None)
+        self._socket_path = socket_path(path)
+
+    def connect(self, migrate=True):
+        logger.info("Connecting to finance daemon for '%s'", self._path)
+        info = self._call('info')
+        self.has_fulltext_index = info['has_fulltext_index']
+
+    def close(self):
+        logger.info("Disconnecting from finance daemon")
+
+    def migrate(self, dry_run=False):
+        # The daemon migrated the database when it unlocked it.
+        return []
+
+    def backup(self, path):
+        self._call('backup', os.path.abspath(path))
+
+    @property
+    def generation(self):
+        # Other clients of the daemon may have written since the last call.
+        self._call('ping')
+        return self._generation
+
+    def _call(self, method, *args):
+        try:
+            response = _call(self._socket_path, method, args)
+        except OSError as e:
+            # The daemon has locked, e.g. after being idle, since this session began.
+            raise DaemonGone('Finance daemon is no longer running: {}'.format(e))
+        self._generation = response['generation']
+        return response['result']
+
+    def store_transactions(self, txs, chunk_size=None):
+        inserted, skipped = self._call('store_transactions', [tx.as_row() for tx in txs])
+        return inserted, skipped
+
+    def store_transaction(self, tx):
+        tx.tid = self._call('store_transaction', tx.as_row())
+
+    def fetch_batches(self, condition, params, order_by=(), limit=None, size=None, offset=0):
+        # Fetched from the daemon a page at a time, so that neither side holds the
+        # whole result. Pages are separate queries, ordered by id after any requested
+        # order so that they line up.
+        size = size or self.fetch_size
+        page_size = max(size, self.remote_page_size)
+        if 'id' not in [field for field, _ in order_by]:
+            order_by = tuple(order_by) + (('id', False),)
+        while limit is None or limit > 0:
+            count = page_size if limit is None else min(page_size, limit)
+            rows = self._call('fetch_rows', condition, params, order_by, count, offset)
+            for start in range(0, len(rows), size):
+                yield [Transaction.from_row(row) for row in rows[start:start + size]]
+            if len(rows) < count:
+                return
+            offset += count
+            limit = None if limit is None else limit - count
+
+    def fetch_transaction(self, tid):
+        row = self._call('fetch_transaction', tid)
+        return None if row is None else Transaction.from_row(row)
+
+    def has_transaction(self, tx):
+        return self._call('has_transaction', tx.as_row())
+
+    def count_transactions(self, condition, params):
+        return self._call('count_transactions', condition, params)
+
+    def aggregate(self, condition, params, level, aggregates):
+        return [tuple(row) for row in self._call('aggregate', condition, params, level, aggregates)]
+
+    def extremum(self, condition, params, func, field):
+        value = self._call('extremum', condition, params, func, field)
+        if field == 'timestamp' and value is not None:
+            value = _epoch_to_datetime(value)
+        return value
+
+    def monthly_aggregate(self, month, level, aggregates):
+        return [tuple(row) for row in self._call('monthly_aggregate', month, level, aggregates)]
+
+    def monthly_totals(self):
+        return [tuple(row) for row in self._call('monthly_totals')]
+
+    def rebuild_monthly_totals(self):
+        return self._call('rebuild_monthly_totals')
+
+    def explain(self, condition, params, order_by=(), limit=None):
+        return self._call('explain', condition, params, order_by, limit)
+
+    def select_raw(self, query, params):
+        return [tuple(row) for row in self._call('select_raw', query, params)]
+
+    def update_categories(self, condition, params, categories):
+        return self._call('update_categories', condition, params, categories)
+
+    def get_layout(self, key):
+        return self._call('get_layout', key)
+
+    def store_layout(self, key, rows):
+        self._call('store_layout', key, rows)
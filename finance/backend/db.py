@@ -1,61 +1,139 @@
 import datetime
-import hashlib
 import logging
-from .api import Transaction
-from contextlib import closing
+import shutil
+import time
+from collections import OrderedDict
+from .api import Transaction, _datetime_to_epoch, _epoch_to_datetime
+from .cache import ResultCache, estimate_size
+from .filters import ALL, NOTHING, CategoryPrefix, Predicate, RowId, TimeRange, Untagged
+from .instrumentation import InstrumentedCursor, QueryStats
+from .schema import (BASE_SCHEMA, CATEGORY_IDS, LATEST_VERSION, LEGACY_SCHEMA_VERSIONS, MIGRATIONS,
+                     MONTHLY_TOTALS_QUERY, canonical_merchant, dedup_key)
+from contextlib import closing, contextmanager
 from pysqlcipher3 import dbapi2 as sqlcipher
 
 
 logger = logging.getLogger(__name__)
 query_logger = logging.getLogger(__name__ + 'query')
 
+# Keep well under SQLite's default limit of 999 bound parameters per statement.
+_INGEST_CHUNK_SIZE = 500
 
-_SCHEMA = (
-    ('schema', (
-        ('hash', 'TEXT'),
-    )),
-    ('transactions', (
-        ('id', 'INTEGER PRIMARY KEY'),
-        ('timestamp', 'TIMESTAMP'),
-        ('description', 'TEXT'),
-        ('amount_pence', 'INTEGER'),
-        ('category_1', 'TEXT'),
-        ('category_2', 'TEXT'),
-        ('category_3', 'TEXT'),
-        ('notes', 'TEXT'),
-    )),
-)
+
+_TX_COLUMNS = 'id, timestamp, description, amount_pence, category_1, category_2, category_3, notes'
+
+_ORDERABLE_COLUMNS = ('id', 'timestamp', 'description', 'amount_pence',
+                      'category_1', 'category_2', 'category_3')
+
+_CATEGORY_COLUMNS = ('category_1', 'category_2', 'category_3')
+
+_AGGREGATES = {
+    'sum': 'SUM(amount_pence)',
+    'count': 'COUNT(*)',
+    'min': 'MIN(amount_pence)',
+    'max': 'MAX(amount_pence)',
+}
+
+_HAS_TX = 'SELECT COUNT(*) from transactions WHERE dedup_key=?'
+
+_FETCH_TX = 'SELECT {} from transaction_details WHERE id=?'.format(_TX_COLUMNS)
+
+_COUNT_TX = 'SELECT COUNT(*) from transaction_details WHERE {}'
+
+# Names are stored once in these lookup tables, and referenced from transactions by key.
+_MERCHANT_MATCHES = "merchant_id IN (SELECT id FROM merchants WHERE name LIKE '%' || ? || '%')"
+
+_INTERN_MERCHANT = 'INSERT OR IGNORE INTO merchants (name, canonical) VALUES (?, ?)'
+_INTERN_CATEGORY = 'INSERT OR IGNORE INTO categories (name) VALUES (?)'
+_MERCHANT_ID = '(SELECT id FROM merchants WHERE name=?)'
+_CATEGORY_ID = '(SELECT id FROM categories WHERE name=?)'
+
+_INSERT_TX = """INSERT INTO transactions
+                (timestamp, merchant_id, amount_pence,
+                category_1_id, category_2_id, category_3_id, notes, dedup_key)
+                VALUES (?, {merchant}, ?, {category}, {category}, {category}, ?, ?)
+                ON CONFLICT(dedup_key) DO NOTHING""".format(merchant=_MERCHANT_ID, category=_CATEGORY_ID)
+
+_UPDATE_TX = """UPDATE transactions
+                SET timestamp=?, merchant_id={merchant}, amount_pence=?,
+                    category_1_id={category}, category_2_id={category}, category_3_id={category},
+                    notes=?, dedup_key=?
+                WHERE id=?""".format(merchant=_MERCHANT_ID, category=_CATEGORY_ID)
 
 
 class Connection(object):
+    # Rows pulled from the cursor per fetchmany() call when iterating transactions.
+    fetch_size = 256
+    # Size of the driver's per-connection cache of prepared statements. This is
+    # sqlite3's own default, set here so that it can be changed per connection.
+    statement_cache_size = 128
+    # Number of cursors kept open for reuse by the fixed single-row queries.
+    cursor_cache_size = 8
+    # Limits on the shared cache of query results: distinct queries, and estimated
+    # bytes in total.
+    result_cache_entries = 256
+    result_cache_bytes = 16 * 1024 * 1024
+    # Largest streamed result that is remembered for the cache while it is iterated.
+    result_cache_stream_rows = 1000
+    # Total size of the PDF layouts kept in the database, least recently used first out.
+    layout_cache_bytes = 32 * 1024 * 1024
+    # How stale a layout's last use can get before reading it updates the record.
+    layout_cache_touch_ns = 7 * 24 * 3600 * 10 ** 9
+
     def __init__(self, path, key):
         self.db = None
         self._path = path
         self._key = key
-
-    def connect(self):
+        # Bumped on every write, so that anything derived from the stored data
+        # (e.g. cached view counts) can tell when it has gone stale.
+        self._generation = 0
+        self._data_version = None
+        self.has_fulltext_index = False
+        self.query_stats = None
+        self.result_cache = ResultCache(self.result_cache_entries, self.result_cache_bytes)
+        self._cursors = OrderedDict()
+
+    def connect(self, migrate=True):
         logger.info("Connecting to database at '%s'", self._path)
-        self.db = sqlcipher.connect(self._path)
+        self.db = sqlcipher.connect(self._path, cached_statements=self.statement_cache_size)
         self._do_crypto()
 
         if not self._is_seeded():
             self._seed()
 
-        self._assert_schema_hash()
+        self._assert_schema_version()
+        if migrate:
+            self.migrate()
+        else:
+            self.has_fulltext_index = self._has_table('transactions_fts')
 
     def close(self):
         if self.db is not None:
             logger.info("Closing database")
+            self._close_cursors()
             self.db.close()
         else:
             logger.warn("Close called on uninitialized database")
 
-    def _do_crypto(self):
-        with self._safe_cursor() as c:
+    def _do_crypto(self, db=None):
+        with closing((db or self.db).cursor()) as c:
             logger.debug("Setting up crypto")
             c.execute('pragma key="%s";' % self._key)
             c.execute('pragma kdf_iter=64000;')
 
+    def backup(self, path):
+        if hasattr(self.db, 'backup'):
+            # SQLite's online backup API copies a consistent snapshot page by page.
+            with closing(sqlcipher.connect(path)) as target:
+                self._do_crypto(target)
+                self.db.backup(target)
+        else:
+            # Drivers without the backup API: copy the (encrypted) file verbatim while
+            # a read transaction stops writers from committing mid-copy.
+            with self._transaction(commit=False) as c:
+                c.execute('SELECT COUNT(*) FROM schema').fetchone()
+                shutil.copyfile(self._path, path)
+
     def _is_seeded(self):
         try:
             with self._safe_cursor() as c:
@@ -68,48 +146,148 @@ class Connection(object):
     def _seed(self):
         logger.info("Seeding database")
         with self._safe_cursor() as c:
-            for table, cols in _SCHEMA:
+            for table, cols in BASE_SCHEMA:
                 col_descriptor = ','.join(('%s %s' % col for col in cols))
                 c.execute('CREATE TABLE %s (%s)' % (table, col_descriptor))
-            schema_version = self._schema_hash()
-            c.execute('INSERT INTO schema VALUES (?)', (schema_version,))
+            c.execute('INSERT INTO schema (version) VALUES (0)')
             self.db.commit()
-            logger.info("Seeded database with schema version %s", schema_version)
-
-    def _schema_hash(self):
-        m = hashlib.md5()
-        for table, cols in _SCHEMA:
-            m.update(b'#')
-            m.update(table.encode('utf-8'))
-            for col_name, col_type in cols:
-                m.update(b'|')
-                m.update(col_name.encode('utf-8'))
-                m.update(b'|')
-                m.update(col_type.encode('utf-8'))
-        return m.hexdigest()
-
-    def _assert_schema_hash(self):
-        expected_hash = self._schema_hash()
-        c = self.db.cursor()
+            logger.info("Seeded database with base schema")
+
+    def schema_version(self):
+        with self._safe_cursor() as c:
+            try:
+                return c.execute('SELECT version FROM schema').fetchone()[0]
+            except sqlcipher.OperationalError:
+                # Databases from before versioned migrations only have a schema hash.
+                db_hash = str(c.execute('SELECT hash FROM schema').fetchone()[0])
+                if db_hash not in LEGACY_SCHEMA_VERSIONS:
+                    raise SchemaMismatch(LATEST_VERSION, db_hash)
+                return LEGACY_SCHEMA_VERSIONS[db_hash]
+
+    def _has_table(self, name):
+        with self._safe_cursor() as c:
+            q = "SELECT COUNT(*) FROM sqlite_master WHERE type='table' AND name=?"
+            return c.execute(q, (name,)).fetchone()[0] == 1
+
+    def _assert_schema_version(self):
         success = False
         try:
-            db_hash = str(c.execute('SELECT * FROM schema').fetchone()[0])
-            if db_hash != expected_hash:
-                raise SchemaMismatch(expected_hash, db_hash)
+            version = self.schema_version()
+            if version > LATEST_VERSION:
+                raise SchemaMismatch(LATEST_VERSION, version)
             success = True
         finally:
-            c.close()
             if not success:
                 self.db.close()
 
+    def migrate(self, dry_run=False):
+        version = self.schema_version()
+        pending = [m for m in MIGRATIONS if m.version > version]
+        if dry_run:
+            # Apply everything and roll back, so a dry run also catches migrations
+            # that would fail against this particular database.
+            with self._transaction(commit=False) as c:
+                for migration in pending:
+                    migration.apply(c)
+            return pending
+
+        for migration in pending:
+            logger.info("Applying schema migration %d: %s", migration.version, migration.description)
+            with self._transaction() as c:
+                migration.apply(c)
+                self._record_schema_version(c, migration.version)
+        if len(pending) > 0:
+            logger.info("Database schema is now at version %d", self.schema_version())
+            self._data_changed()
+        self.has_fulltext_index = self._has_table('transactions_fts')
+        return pending
+
+    def _record_schema_version(self, c, version):
+        try:
+            c.execute('UPDATE schema SET version=?', (version,))
+        except sqlcipher.OperationalError:
+            c.execute('ALTER TABLE schema ADD COLUMN version INTEGER')
+            c.execute('UPDATE schema SET version=?', (version,))
+
+    def enable_query_stats(self):
+        if self.query_stats is None:
+            self.query_stats = QueryStats()
+            self._close_cursors()
+        return self.query_stats
+
+    def disable_query_stats(self):
+        self.query_stats = None
+        self._close_cursors()
+
     def _safe_cursor(self):
-        return closing(LoggingProxy(self.db.cursor()))
+        c = self.db.cursor()
+        if self.query_stats is not None or query_logger.isEnabledFor(logging.DEBUG):
+            c = InstrumentedCursor(c, self.query_stats, query_logger)
+        return closing(c)
+
+    def _reusable_cursor(self, sql):
+        # Cursors for the fixed single-row statements, kept open between calls. The
+        # driver's statement cache then serves the prepared statement for the same
+        # SQL text. Callers must consume results before returning.
+        c = self._cursors.pop(sql, None)
+        if c is None:
+            c = self.db.cursor()
+            if self.query_stats is not None or query_logger.isEnabledFor(logging.DEBUG):
+                c = InstrumentedCursor(c, self.query_stats, query_logger)
+            if len(self._cursors) >= self.cursor_cache_size:
+                _, evicted = self._cursors.popitem(last=False)
+                evicted.close()
+        self._cursors[sql] = c
+        return c
+
+    def _close_cursors(self):
+        for c in self._cursors.values():
+            c.close()
+        self._cursors.clear()
+
+    @contextmanager
+    def _transaction(self, commit=True):
+        # Run the block inside one explicit BEGIN/COMMIT rather than relying on the
+        # driver's implicit per-statement transactions, so that bulk writes cost a
+        # single commit.
+        self.db.commit()
+        isolation_level = self.db.isolation_level
+        self.db.isolation_level = None
+        try:
+            with self._safe_cursor() as c:
+                c.execute('BEGIN')
+                try:
+                    yield c
+                except BaseException:
+                    c.execute('ROLLBACK')
+                    raise
+                c.execute('COMMIT' if commit else 'ROLLBACK')
+        finally:
+            self.db.isolation_level = isolation_level
 
-    def store_transactions(self, txs):
+    def store_transactions(self, txs, chunk_size=_INGEST_CHUNK_SIZE):
+        txs = list(txs)
         logger.debug("Storing %d transactions", len(txs))
-        for tx in txs:
-            self.store_transaction(tx)
-        logger.info("Stored %d transactions", len(txs))
+        inserted, skipped = 0, 0
+        with self._transaction() as c:
+            for start in range(0, len(txs), chunk_size):
+                chunk = txs[start:start + chunk_size]
+                new_txs = [tx for tx in chunk if tx.tid is None]
+                updated_txs = [tx for tx in chunk if tx.tid is not None]
+
+                self._intern_names(c, chunk)
+                if len(new_txs) > 0:
+                    # Duplicates, whether already stored or repeated within the batch,
+                    # are dropped by the unique dedup key index.
+                    c.executemany(_INSERT_TX, [self._serialize_tx(tx) for tx in new_txs])
+                    inserted += c.rowcount
+                    skipped += len(new_txs) - c.rowcount
+                if len(updated_txs) > 0:
+                    c.executemany(_UPDATE_TX, [self._serialize_tx(tx) + (tx.tid,) for tx in updated_txs])
+        self._data_changed()
+        logger.info("Stored %d transactions (%d new, %d duplicates skipped)",
+                    len(txs), inserted, skipped)
+        return inserted, skipped
 
     def store_transaction(self, tx):
         if tx.tid is None:
@@ -117,62 +295,218 @@ class Connection(object):
         else:
             self._update_transaction(tx)
 
-    def fetch_transactions(self, condition, params):
+    def fetch_transactions(self, condition, params, order_by=(), limit=None, offset=0):
+        for batch in self.fetch_batches(condition, params, order_by, limit, offset=offset):
+            yield from batch
+
+    @property
+    def generation(self):
+        # Commits made through other connections, e.g. a finance-store run while the
+        # REPL is open, only show up as a change in SQLite's data_version.
+        if self.db is not None:
+            data_version = self.db.execute('PRAGMA data_version').fetchone()[0]
+            if data_version != self._data_version:
+                self._data_version = data_version
+                self._generation += 1
+        return self._generation
+
+    def fetch_batches(self, condition, params, order_by=(), limit=None, size=None, offset=0):
+        size = size or self.fetch_size
+        query = 'SELECT {} from transaction_details WHERE {}'.format(_TX_COLUMNS, condition)
+        query += _order_and_limit_sql(order_by, limit, offset)
+        key = (query, tuple(params))
+        generation = self.generation
+        cached = self.result_cache.get(key, generation)
+        if cached is not None:
+            for start in range(0, len(cached), size):
+                yield [Transaction.from_row(row) for row in cached[start:start + size]]
+            return
+
+        # Stream as usual. Results already known to be small are also remembered, and
+        # stored in the cache once the last batch has been handed out.
+        seen = [] if self._is_small_result(condition, params, limit, generation) else None
+        seen_size = 0
+        with self._safe_cursor() as c:
+            c.execute(query, params)
+            rows = c.fetchmany(size)
+            while len(rows) > 0:
+                if seen is not None:
+                    seen.extend(rows)
+                    # Stop remembering rows once they couldn't fit in the cache anyway.
+                    seen_size += estimate_size(rows)
+                    if seen_size > self.result_cache.max_bytes:
+                        seen = None
+                yield [Transaction.from_row(row) for row in rows]
+                rows = c.fetchmany(size)
+        if seen is not None:
+            self.result_cache.put(key, generation, tuple(seen))
+
+    def _is_small_result(self, condition, params, limit, generation):
+        if limit is not None and limit <= self.result_cache_stream_rows:
+            return True
+        count = self.result_cache.peek((_COUNT_TX.format(condition), tuple(params)), generation)
+        return count is not None and count[0][0] <= self.result_cache_stream_rows
+
+    def _cached_query(self, query, params=()):
+        key = (query, tuple(params))
+        generation = self.generation
+        rows = self.result_cache.get(key, generation)
+        if rows is None:
+            with self._safe_cursor() as c:
+                rows = tuple(c.execute(query, params).fetchall())
+            self.result_cache.put(key, generation, rows)
+        return list(rows)
+
+    def count_transactions(self, condition, params):
+        return self._cached_query(_COUNT_TX.format(condition), params)[0][0]
+
+    def aggregate(self, condition, params, level, aggregates):
+        if not 0 <= level <= len(_CATEGORY_COLUMNS):
+            raise ValueError('Invalid category level {}'.format(level))
+        # Group on the category keys, and only look up the names once per group.
+        projection = [_AGGREGATES[agg] for agg in aggregates]
+        query = 'SELECT {} from transaction_details WHERE {}'.format(
+            ', '.join(_CATEGORY_COLUMNS[:level] + tuple(projection)), condition)
+        if level > 0:
+            query += ' GROUP BY {} ORDER BY {}'.format(
+                ', '.join(CATEGORY_IDS[:level]), ', '.join(_CATEGORY_COLUMNS[:level]))
+        return self._cached_query(query, params)
+
+    def monthly_aggregate(self, month, level, aggregates):
+        # As aggregate(), for a single whole month, read from the materialized totals.
+        columns = {'sum': 'SUM(total_pence)', 'count': 'IFNULL(SUM(tx_count), 0)'}
+        names = tuple('(SELECT name FROM categories WHERE categories.id = monthly_totals.{})'.format(col)
+                      for col in CATEGORY_IDS[:level])
+        query = 'SELECT {} from monthly_totals WHERE month=?'.format(
+            ', '.join(names + tuple(columns[agg] for agg in aggregates)))
+        if level > 0:
+            query += ' GROUP BY {} ORDER BY {}'.format(', '.join(CATEGORY_IDS[:level]), ', '.join(names))
+        return self._cached_query(query, (month,))
+
+    def monthly_totals(self):
+        q = 'SELECT month, SUM(total_pence), SUM(tx_count) from monthly_totals GROUP BY month ORDER BY month'
+        return self._cached_query(q)
+
+    def rebuild_monthly_totals(self):
+        # Recomputes the materialized monthly totals from scratch, returning how many
+        # buckets were missing, stale or spurious.
+        with self._transaction() as c:
+            expected = set(c.execute(MONTHLY_TOTALS_QUERY).fetchall())
+            actual = set(c.execute('''SELECT bucket, month, category_1_id, category_2_id, category_3_id,
+                                             total_pence, tx_count FROM monthly_totals''').fetchall())
+            if expected != actual:
+                c.execute('DELETE FROM monthly_totals')
+                c.execute('INSERT INTO monthly_totals ' + MONTHLY_TOTALS_QUERY)
+        if expected != actual:
+            self._data_changed()
+        return len(expected ^ actual)
+
+    def extremum(self, condition, params, func, field):
+        if func not in ('MIN', 'MAX') or field not in _ORDERABLE_COLUMNS:
+            raise ValueError('Invalid extremum {}({})'.format(func, field))
+        query = 'SELECT {}({}) from transaction_details WHERE {}'.format(func, field, condition)
+        value = self._cached_query(query, params)[0][0]
+        if field == 'timestamp' and value is not None:
+            value = _epoch_to_datetime(value)
+        return value
+
+    def explain(self, condition, params, order_by=(), limit=None):
         with self._safe_cursor() as c:
-            query = 'SELECT * from transactions WHERE {}'.format(condition)
-            qs = c.execute(query, params)
-            for row in qs:
-                yield self._deserialize_tx(row)
+            query = 'EXPLAIN QUERY PLAN SELECT {} from transaction_details WHERE {}'.format(_TX_COLUMNS, condition)
+            query += _order_and_limit_sql(order_by, limit)
+            return [row[-1] for row in c.execute(query, params)]
+
+    def fetch_transaction(self, tid):
+        row = self._reusable_cursor(_FETCH_TX).execute(_FETCH_TX, (tid,)).fetchone()
+        return None if row is None else Transaction.from_row(row)
 
     def has_transaction(self, tx):
-        with self._safe_cursor() as c:
-            t_serial = self._serialize_tx(tx)
-            q = '''SELECT COUNT(*) from transactions WHERE
-                     timestamp=? AND
-                     description=? AND
-                     amount_pence=?'''
-            res = c.execute(q, t_serial[:3]).fetchone()[0]
-            assert(res in [0, 1])
-            return res == 1
+        key = dedup_key(tx.epoch, tx.description, tx.amount_pence)
+        res = self._reusable_cursor(_HAS_TX).execute(_HAS_TX, (key,)).fetchone()[0]
+        return res == 1
 
     def select_raw(self, query, params):
-        with self._safe_cursor() as c:
-            return c.execute(query, params).fetchall()
+        return self._cached_query(query, params)
 
     def _create_transaction(self, tx):
-        if self.has_transaction(tx):
-            return
-
         with self._safe_cursor() as c:
-            c.execute("""INSERT INTO transactions
-                        (timestamp, description, amount_pence,
-                        category_1, category_2, category_3, notes)
-                        VALUES (?, ?, ?, ?, ?, ?, ?)""",
-                      self._serialize_tx(tx))
-            self.db.commit()
+            self._intern_names(c, (tx,))
+        c = self._reusable_cursor(_INSERT_TX)
+        c.execute(_INSERT_TX, self._serialize_tx(tx))
+        self.db.commit()
+        if c.rowcount == 1:
             tx.tid = c.lastrowid
+            self._data_changed()
 
     def _update_transaction(self, tx):
         assert(self.has_transaction(tx))
         with self._safe_cursor() as c:
-            c.execute("""UPDATE transactions
-                         SET timestamp=?, description=?, amount_pence=?,
-                             category_1=?, category_2=?, category_3=?, notes=?
-                         WHERE id=?""",
-                      self._serialize_tx(tx) + (tx.tid,))
-            assert c.rowcount == 1, "Expected one row updated, got " + str(c.rowcount)
-            self.db.commit()
+            self._intern_names(c, (tx,))
+        c = self._reusable_cursor(_UPDATE_TX)
+        c.execute(_UPDATE_TX, self._serialize_tx(tx) + (tx.tid,))
+        assert c.rowcount == 1, "Expected one row updated, got " + str(c.rowcount)
+        self.db.commit()
+        self._data_changed()
+
+    def update_categories(self, condition, params, categories):
+        categories = tuple(categories)
+        if len(categories) > len(_CATEGORY_COLUMNS):
+            raise ValueError('Invalid categories "{}" - max 3 categories allowed'.format(categories))
+        categories += (None,) * (len(_CATEGORY_COLUMNS) - len(categories))
+        with self._transaction() as c:
+            c.executemany(_INTERN_CATEGORY, [(name,) for name in set(categories) if name is not None])
+            c.execute('''UPDATE transactions SET category_1_id={0}, category_2_id={0}, category_3_id={0}
+                         WHERE id IN (SELECT id from transaction_details WHERE {1})'''.format(_CATEGORY_ID, condition),
+                      categories + tuple(params))
+            updated = c.rowcount
+        self._data_changed()
+        return updated
+
+    def get_layout(self, key):
+        with self._safe_cursor() as c:
+            row = c.execute('SELECT rows, last_used FROM layout_cache WHERE key=?', (key,)).fetchone()
+        if row is None:
+            return None
+        # Only record the use once it is worth it for eviction, so that reading cached
+        # layouts doesn't normally write to (and so change) the database file.
+        now = time.time_ns()
+        if now - row[1] > self.layout_cache_touch_ns:
+            with self._transaction() as c:
+                c.execute('UPDATE layout_cache SET last_used=? WHERE key=?', (now, key))
+        return row[0]
+
+    def store_layout(self, key, rows):
+        with self._transaction() as c:
+            c.execute('INSERT OR REPLACE INTO layout_cache (key, rows, size, last_used) VALUES (?, ?, ?, ?)',
+                      (key, rows, len(rows), time.time_ns()))
+            total = 0
+            evicted = []
+            for cached_key, size in c.execute('SELECT key, size FROM layout_cache ORDER BY last_used DESC'):
+                total += size
+                if total > self.layout_cache_bytes:
+                    evicted.append((cached_key,))
+            c.executemany('DELETE FROM layout_cache WHERE key=?', evicted)
+        if len(evicted) > 0:
+            logger.info("Evicted %d layouts from the layout cache", len(evicted))
+
+    def _data_changed(self):
+        self._generation += 1
+
+    def _intern_names(self, c, txs):
+        # Make sure every name the transactions refer to has a key before they're written.
+        merchants = set(tx.description for tx in txs if tx.description is not None)
+        categories = set(cat for tx in txs for cat in (tx.category_1, tx.category_2, tx.category_3)
+                         if cat is not None)
+        c.executemany(_INTERN_MERCHANT, [(name, canonical_merchant(name)) for name in merchants])
+        c.executemany(_INTERN_CATEGORY, [(name,) for name in categories])
 
     def _serialize_tx(self, tx):
-        return (_datetime_to_epoch(tx.timestamp),
+        epoch = tx.epoch
+        return (epoch,
                 tx.description, tx.amount_pence,
                 tx.category_1, tx.category_2, tx.category_3,
-                tx.notes)
-
-    def _deserialize_tx(self, tx_row):
-        tx = Transaction(*tx_row)
-        tx.timestamp = _epoch_to_datetime(tx.timestamp)
-        return tx
+                tx.notes,
+                dedup_key(epoch, tx.description, tx.amount_pence))
 
     def filter(self, criterion):
         return View(self, criterion)
@@ -182,76 +516,199 @@ class Connection(object):
 
 
 class View(object):
-    def __init__(self, parent, filter_data):
+    def __init__(self, parent, condition):
         if isinstance(parent, Connection):
             self.db = parent
-            self.filter_str = filter_data[0]
-            self.filter_params = filter_data[1]
+            self.condition = condition
+            self.order = ()
+            self.row_limit = None
+        elif isinstance(parent, View) and parent.row_limit is not None:
+            # Filter the limited view's rows themselves, so that a child only ever
+            # narrows its parent.
+            self.db = parent.db
+            self.condition = Predicate(*parent._selection()) & condition
+            self.order = ()
+            self.row_limit = None
         elif isinstance(parent, View):
             self.db = parent.db
-            self.filter_str = '{} AND {}'.format(parent.filter_str, filter_data[0])
-            self.filter_params = parent.filter_params + filter_data[1]
+            self.condition = parent.condition & condition
+            self.order = parent.order
+            self.row_limit = parent.row_limit
         else:
             raise ValueError('Unexpected type %s', str(parent.__class__))
+        # Set on views that select exactly one calendar month of the whole table, which
+        # can be aggregated from the materialized monthly totals.
+        self.month_key = None
+        self._count = None
+        self._count_generation = None
 
     def __iter__(self):
-        return self.db.fetch_transactions(self.filter_str, self.filter_params)
+        if self.condition == NOTHING:
+            return iter(())
+        return self.db.fetch_transactions(*self.condition.to_sql(), self.order, self.row_limit)
 
     def __len__(self):
-        try:
-            return sum(1 for _ in self)
-        except sqlcipher.InterfaceError as e:
-            raise Exception('{} with {}'.format(self.filter_str, self.filter_params), e)
+        if self.condition == NOTHING:
+            return 0
+        generation = self.db.generation
+        if self._count_generation != generation:
+            filter_str, filter_params = self.condition.to_sql()
+            try:
+                self._count = self.db.count_transactions(filter_str, filter_params)
+            except sqlcipher.InterfaceError as e:
+                raise Exception('{} with {}'.format(filter_str, filter_params), e)
+            if self.row_limit is not None:
+                self._count = min(self._count, self.row_limit)
+            self._count_generation = generation
+        return self._count
 
     def filter(self, criterion):
         return View(self, criterion)
 
+    def iter_batches(self, n=None):
+        if self.condition == NOTHING:
+            return iter(())
+        return self.db.fetch_batches(*self.condition.to_sql(), self.order, self.row_limit, n)
+
+    def page_after(self, key, n):
+        # Keyset pagination in (timestamp, id) order: the first n transactions after
+        # key, a (epoch, tid) pair, or from the start when key is None.
+        return self._page(key, n, '>', False)
+
+    def page_before(self, key, n):
+        # As page_after(), for the n transactions before key, or the last n when key
+        # is None. Returned in ascending order.
+        return list(reversed(self._page(key, n, '<', True)))
+
+    def _page(self, key, n, op, descending):
+        if self.condition == NOTHING:
+            return []
+        condition, params = self._selection()
+        if key is not None:
+            condition = '({}) AND (timestamp, id) {} (?, ?)'.format(condition, op)
+            params = tuple(params) + tuple(key)
+        order = (('timestamp', descending), ('id', descending))
+        return list(self.db.fetch_transactions(condition, params, order, n))
+
+    def order_by(self, *fields, descending=False):
+        for field in fields:
+            if field not in _ORDERABLE_COLUMNS:
+                raise ValueError('Cannot order by unknown field "{}"'.format(field))
+        view = self._copy()
+        view.order = tuple((field, descending) for field in fields)
+        return view
+
+    def limit(self, n):
+        view = self._copy()
+        view.row_limit = n
+        view.month_key = None
+        return view
+
+    def month(self, year, month):
+        month_range = Filter.month(year, month)
+        view = View(self, month_range)
+        # Wider filters on the timestamp alone collapse into the month's range.
+        if view.condition == month_range and self.row_limit is None:
+            view.month_key = '{:04d}-{:02d}'.format(year, month)
+        return view
+
+    def max(self, field):
+        return self.db.extremum(*self._selection(), 'MAX', field)
+
+    def min(self, field):
+        return self.db.extremum(*self._selection(), 'MIN', field)
+
+    def update_categories(self, *categories):
+        return self.db.update_categories(*self._selection(), categories)
+
+    def aggregate(self, level=3, aggregates=('sum', 'count', 'min', 'max')):
+        # One row per distinct category prefix of the given depth, holding the
+        # prefix followed by the requested aggregates of amount_pence.
+        if self.month_key is not None and set(aggregates) <= {'sum', 'count'}:
+            return self.db.monthly_aggregate(self.month_key, level, aggregates)
+        return self.db.aggregate(*self._selection(), level, aggregates)
+
+    def explain(self):
+        return self.db.explain(*self.condition.to_sql(), self.order, self.row_limit)
+
+    def _copy(self):
+        view = View(self.db, self.condition)
+        view.order = self.order
+        view.row_limit = self.row_limit
+        view.month_key = self.month_key
+        return view
+
+    def _selection(self):
+        # The view's rows as a plain condition, for queries that cannot take the
+        # view's ORDER BY and LIMIT directly.
+        filter_str, filter_params = self.condition.to_sql()
+        if self.row_limit is None:
+            return filter_str, filter_params
+        subquery = 'id IN (SELECT id from transaction_details WHERE {}{})'.format(
+            filter_str, _order_and_limit_sql(self.order, self.row_limit))
+        return subquery, filter_params
+
 
 class Filter(object):
+    # Each filter is a Condition; View combines them with & so that overlapping
+    # filters are simplified before any SQL is generated.
     @staticmethod
     def all():
-        return ('1', ())
+        return ALL
 
     @staticmethod
     def description(substr):
-        return ('description LIKE "%" || ? || "%"', (substr,))
+        # Match against the distinct merchant names rather than every transaction.
+        return Predicate(_MERCHANT_MATCHES, (substr,))
+
+    @staticmethod
+    def merchant(name):
+        # Every description naming this merchant, whatever references it carries.
+        return Predicate('merchant_id IN (SELECT id FROM merchants WHERE canonical=?)', (canonical_merchant(name),))
+
+    @staticmethod
+    def text_search(term, indexed=False):
+        # Case-insensitive substring match on description or notes. Only pass
+        # indexed=True where the connection has_fulltext_index: builds without FTS5
+        # trigram support have no index. It can only match terms of three or more
+        # characters.
+        if indexed and len(term) >= 3:
+            phrase = '"{}"'.format(term.replace('"', '""'))
+            return Predicate('id IN (SELECT rowid FROM transactions_fts WHERE transactions_fts MATCH ?)', (phrase,))
+        return Predicate(_MERCHANT_MATCHES + " OR notes LIKE '%' || ? || '%'", (term, term))
 
     @staticmethod
     def category(categories):
-        query_parts = ['category_1=?']
-        if len(categories) > 1:
-            query_parts.append('category_2=?')
-        if len(categories) > 2:
-            query_parts.append('category_3=?')
         if len(categories) > 3:
             raise ValueError('Invalid category filter "{}" - max 3 categories allowed'.format(categories))
-        query = ' AND '.join(query_parts)
-        return (query, categories)
+        return CategoryPrefix(categories)
 
     @staticmethod
     def date_range(start_incl, end_incl):
-        start_epoch = _datetime_to_epoch(start_incl)
-        end_epoch = _datetime_to_epoch(end_incl)
-        query = 'timestamp >= ? AND timestamp <= ?'
-        return (query, (start_epoch, end_epoch))
+        return TimeRange(_datetime_to_epoch(start_incl), _datetime_to_epoch(end_incl))
+
+    @staticmethod
+    def month(year, month):
+        start = datetime.datetime(year, month, 1)
+        end = datetime.datetime(year + month // 12, month % 12 + 1, 1)
+        return TimeRange(_datetime_to_epoch(start), _datetime_to_epoch(end), upper_inclusive=False)
 
     @staticmethod
     def date_before(start_incl):
-        start_epoch = _datetime_to_epoch(start_incl)
-        return ('timestamp <= ?', (start_epoch,))
+        return TimeRange(upper=_datetime_to_epoch(start_incl))
 
     @staticmethod
     def date_after(end_incl):
-        end_epoch = _datetime_to_epoch(end_incl)
-        return ('timestamp >= ?', (end_epoch,))
+        return TimeRange(lower=_datetime_to_epoch(end_incl))
 
     @staticmethod
     def id(tid):
-        return ('id = ?', (tid,))
+        # Bind an integer so SQLite can look the row up by rowid.
+        return RowId(int(tid))
 
     @staticmethod
     def untagged():
-        return ('category_1 IS NULL', tuple())
+        return Untagged()
 
 
 class SchemaMismatch(Exception):
@@ -260,30 +717,16 @@ class SchemaMismatch(Exception):
         super(SchemaMismatch, self).__init__(msg)
 
 
-def _datetime_to_epoch(dt):
-    epoch = datetime.datetime.utcfromtimestamp(0)
-    return int((dt - epoch).total_seconds() * 1000000)
-
-
-def _epoch_to_datetime(dt):
-    return datetime.datetime.utcfromtimestamp(dt / 1000000)
-
-
-class LoggingProxy(object):
-    def __init__(self, delegate):
-        self.delegate = delegate
-
-    def __getattr__(self, attr):
-        delegate_f = getattr(self.delegate, attr)
-        if callable(delegate_f):
-            def f(*args, **kwargs):
-                query_logger.debug("DB call: args='%s', kwargs='%s'", args, kwargs)
-                res = delegate_f(*args, **kwargs)
-                return res
-            return f
-        else:
-            query_logger.debug("DB attribute '%s' is '%s'", attr, str(delegate_f))
-            return delegate_f
+def _order_and_limit_sql(order_by, limit, offset=0):
+    sql = ''
+    if len(order_by) > 0:
+        sql += ' ORDER BY ' + ', '.join(
+            '{} {}'.format(field, 'DESC' if descending else 'ASC') for field, descending in order_by)
+    if limit is not None or offset > 0:
+        sql += ' LIMIT {:d}'.format(-1 if limit is None else limit)
+    if offset > 0:
+        sql += ' OFFSET {:d}'.format(offset)
+    return sql
 
 
 if __name__ == '__main__':
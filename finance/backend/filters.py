@@ -0,0 +1,226 @@
+class Condition(object):
+    # A predicate over the transactions table. Conditions are combined with & into a
+    # simplified conjunction, and only turned into SQL when a query is run.
+    # Lower ranks are emitted first in the WHERE clause.
+    rank = 3
+
+    def key(self):
+        raise NotImplementedError
+
+    def to_sql(self):
+        raise NotImplementedError
+
+    def terms(self):
+        return (self,)
+
+    def merge(self, other):
+        # The conjunction of self and other as a single condition, or None if the
+        # two can't be combined.
+        return self if self == other else None
+
+    def __and__(self, other):
+        return conjunction(self, other)
+
+    def __eq__(self, other):
+        return type(self) is type(other) and self.key() == other.key()
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash((type(self), self.key()))
+
+    def __repr__(self):
+        return '{}{!r}'.format(type(self).__name__, self.key())
+
+
+class All(Condition):
+    def key(self):
+        return ()
+
+    def to_sql(self):
+        return ('1', ())
+
+    def terms(self):
+        return ()
+
+
+class Nothing(Condition):
+    # A conjunction that can never hold, e.g. two different months.
+    def key(self):
+        return ()
+
+    def to_sql(self):
+        return ('0', ())
+
+
+ALL = All()
+NOTHING = Nothing()
+
+
+class Predicate(Condition):
+    # Opaque SQL, only deduplicated against identical predicates.
+    def __init__(self, sql, params):
+        self.sql = sql
+        self.params = tuple(params)
+
+    def key(self):
+        return (self.sql, self.params)
+
+    def to_sql(self):
+        return ('({})'.format(self.sql), self.params)
+
+
+class RowId(Condition):
+    rank = 0
+
+    def __init__(self, tid):
+        self.tid = tid
+
+    def key(self):
+        return (self.tid,)
+
+    def to_sql(self):
+        return ('id = ?', (self.tid,))
+
+    def merge(self, other):
+        if isinstance(other, RowId):
+            return self if self == other else NOTHING
+        return None
+
+
+class TimeRange(Condition):
+    # Bounds are epochs, or None where the range is open.
+    rank = 1
+
+    def __init__(self, lower=None, upper=None, lower_inclusive=True, upper_inclusive=True):
+        self.lower = lower
+        self.upper = upper
+        self.lower_inclusive = lower_inclusive
+        self.upper_inclusive = upper_inclusive
+
+    def key(self):
+        return (self.lower, self.lower_inclusive, self.upper, self.upper_inclusive)
+
+    def is_empty(self):
+        if self.lower is None or self.upper is None:
+            return False
+        if self.lower == self.upper:
+            return not (self.lower_inclusive and self.upper_inclusive)
+        return self.lower > self.upper
+
+    def to_sql(self):
+        if self.lower is not None and self.lower == self.upper:
+            return ('timestamp = ?', (self.lower,))
+        parts = []
+        params = ()
+        if self.lower is not None:
+            parts.append('timestamp >= ?' if self.lower_inclusive else 'timestamp > ?')
+            params += (self.lower,)
+        if self.upper is not None:
+            parts.append('timestamp <= ?' if self.upper_inclusive else 'timestamp < ?')
+            params += (self.upper,)
+        return (' AND '.join(parts), params)
+
+    def merge(self, other):
+        if not isinstance(other, TimeRange):
+            return None
+        lower, lower_inclusive = _tighter(self.lower, self.lower_inclusive, other.lower, other.lower_inclusive, max)
+        upper, upper_inclusive = _tighter(self.upper, self.upper_inclusive, other.upper, other.upper_inclusive, min)
+        merged = TimeRange(lower, upper, lower_inclusive, upper_inclusive)
+        return NOTHING if merged.is_empty() else merged
+
+
+class CategoryPrefix(Condition):
+    # Matches transactions whose leading categories equal the given ones.
+    rank = 2
+
+    def __init__(self, categories):
+        self.categories = tuple(categories)
+
+    def key(self):
+        return self.categories
+
+    def to_sql(self):
+        # Looking the names up once lets the category index compare keys.
+        columns = ('category_1_id', 'category_2_id', 'category_3_id')
+        return (' AND '.join('{}=(SELECT id FROM categories WHERE name=?)'.format(column)
+                             for column in columns[:len(self.categories)]), self.categories)
+
+    def merge(self, other):
+        if isinstance(other, Untagged):
+            return NOTHING
+        if not isinstance(other, CategoryPrefix):
+            return None
+        shorter, longer = sorted((self, other), key=lambda c: len(c.categories))
+        if longer.categories[:len(shorter.categories)] != shorter.categories:
+            return NOTHING
+        return longer
+
+
+class Untagged(Condition):
+    rank = 2
+
+    def key(self):
+        return ()
+
+    def to_sql(self):
+        return ('category_1_id IS NULL', ())
+
+    def merge(self, other):
+        if isinstance(other, CategoryPrefix):
+            return NOTHING
+        return Condition.merge(self, other)
+
+
+class And(Condition):
+    # Built by conjunction(), which guarantees at least two terms, none of which can
+    # be merged with another.
+    def __init__(self, terms):
+        self._terms = tuple(terms)
+
+    def key(self):
+        return self._terms
+
+    def terms(self):
+        return self._terms
+
+    def to_sql(self):
+        sql = []
+        params = ()
+        for term in self._terms:
+            term_sql, term_params = term.to_sql()
+            sql.append(term_sql)
+            params += tuple(term_params)
+        return (' AND '.join(sql), params)
+
+
+def conjunction(*conditions):
+    merged = []
+    for condition in conditions:
+        for term in condition.terms():
+            for i, existing in enumerate(merged):
+                combined = existing.merge(term)
+                if combined is not None:
+                    merged[i] = combined
+                    break
+            else:
+                merged.append(term)
+            if NOTHING in merged:
+                return NOTHING
+    if len(merged) == 0:
+        return ALL
+    if len(merged) == 1:
+        return merged[0]
+    return And(sorted(merged, key=lambda term: term.rank))
+
+
+def _tighter(a, a_inclusive, b, b_inclusive, pick):
+    # The more restrictive of two bounds on the same side of a range.
+    if a is None:
+        return b, b_inclusive
+    if b is None:
+        return a, a_inclusive
+    if a == b:
+        return a, a_inclusive and b_inclusive
+    return (a, a_inclusive) if pick(a, b) == a else (b, b_inclusive)
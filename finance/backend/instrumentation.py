@@ -0,0 +1,141 @@
+import logging
+import time
+
+
+class StatementStats(object):
+    __slots__ = ('calls', 'rows', 'total_time', 'fetch_time', 'max_time', 'histogram')
+
+    def __init__(self):
+        self.calls = 0
+        self.rows = 0
+        # Time spent in execute() and in fetching rows. The per-call figures (max_time,
+        # the histogram and so the percentiles) only cover execute().
+        self.total_time = 0.0
+        self.fetch_time = 0.0
+        self.max_time = 0.0
+        # histogram[i] counts calls that took under 2**i microseconds (and at least
+        # 2**(i-1)), so buckets grow geometrically from 1us upwards.
+        self.histogram = []
+
+    def add_call(self, elapsed):
+        self.calls += 1
+        self.total_time += elapsed
+        self.max_time = max(self.max_time, elapsed)
+        bucket = int(elapsed * 1000000).bit_length()
+        if bucket >= len(self.histogram):
+            self.histogram.extend([0] * (bucket + 1 - len(self.histogram)))
+        self.histogram[bucket] += 1
+
+    def add_fetch(self, elapsed, rows):
+        self.rows += rows
+        self.total_time += elapsed
+        self.fetch_time += elapsed
+
+    def execute_time(self):
+        return self.total_time - self.fetch_time
+
+    def percentile(self, fraction):
+        # Upper bound, in seconds, of the bucket holding the given fraction of calls.
+        threshold = fraction * self.calls
+        seen = 0
+        for bucket, count in enumerate(self.histogram):
+            seen += count
+            if seen >= threshold and count > 0:
+                return min((2 ** bucket) / 1000000, self.max_time)
+        return 0.0
+
+
+class QueryStats(object):
+    def __init__(self):
+        self.statements = {}
+
+    def for_statement(self, sql):
+        stats = self.statements.get(sql)
+        if stats is None:
+            stats = self.statements[sql] = StatementStats()
+        return stats
+
+    def reset(self):
+        self.statements = {}
+
+    def report(self, limit=None):
+        ordered = sorted(self.statements.items(), key=lambda item: item[1].total_time, reverse=True)
+        if limit is not None:
+            ordered = ordered[:limit]
+        # Totals include fetching rows; the exec_ columns only time execute() itself.
+        lines = ['{:>7} {:>8} {:>10} {:>10} {:>10} {:>10} {:>10}  {}'.format(
+            'calls', 'rows', 'total_ms', 'fetch_ms', 'exec_mean', 'exec_p95', 'exec_max', 'statement')]
+        for sql, stats in ordered:
+            lines.append('{:>7} {:>8} {:>10.2f} {:>10.2f} {:>10.3f} {:>10.3f} {:>10.3f}  {}'.format(
+                stats.calls,
+                stats.rows,
+                stats.total_time * 1000,
+                stats.fetch_time * 1000,
+                stats.execute_time() * 1000 / max(stats.calls, 1),
+                stats.percentile(0.95) * 1000,
+                stats.max_time * 1000,
+                ' '.join(sql.split()),
+            ))
+        return lines
+
+
+class InstrumentedCursor(object):
+    # Wraps a DB-API cursor to time statements and count the rows they return. Only
+    # used while query stats or query debug logging are switched on; otherwise
+    # Connection hands out bare cursors.
+    def __init__(self, cursor, stats, logger):
+        self._cursor = cursor
+        self._stats = stats
+        self._logger = logger
+        self._current = None
+        self._fetch_start = None
+
+    def __getattr__(self, attr):
+        return getattr(self._cursor, attr)
+
+    def __iter__(self):
+        while True:
+            rows = self.fetchmany(self._cursor.arraysize)
+            if len(rows) == 0:
+                return
+            yield from rows
+
+    def execute(self, sql, params=()):
+        return self._run(self._cursor.execute, sql, params)
+
+    def executemany(self, sql, seq_of_params):
+        return self._run(self._cursor.executemany, sql, seq_of_params)
+
+    def fetchone(self):
+        row = self._fetch(self._cursor.fetchone)
+        self._add_rows(0 if row is None else 1)
+        return row
+
+    def fetchmany(self, size=None):
+        rows = self._fetch(self._cursor.fetchmany, size or self._cursor.arraysize)
+        self._add_rows(len(rows))
+        return rows
+
+    def fetchall(self):
+        rows = self._fetch(self._cursor.fetchall)
+        self._add_rows(len(rows))
+        return rows
+
+    def _run(self, f, sql, params):
+        if self._logger.isEnabledFor(logging.DEBUG):
+            self._logger.debug("DB call: sql='%s', params='%s'", sql, params)
+        start = time.perf_counter()
+        f(sql, params)
+        elapsed = time.perf_counter() - start
+        if self._stats is not None:
+            self._current = self._stats.for_statement(sql)
+            self._current.add_call(elapsed)
+        return self
+
+    def _fetch(self, f, *args):
+        self._fetch_start = time.perf_counter()
+        return f(*args)
+
+    def _add_rows(self, rows):
+        if self._current is not None:
+            self._current.add_fetch(time.perf_counter() - self._fetch_start, rows)
@@ -1,11 +1,17 @@
 import datetime
+import hashlib
+import itertools
+import json
+import os
 import re
 from .api import Transaction
-from collections import defaultdict
+from collections import defaultdict, deque
+from concurrent.futures import ProcessPoolExecutor
+from pdfminer.pdfdevice import PDFTextDevice
+from pdfminer.pdffont import PDFUnicodeNotDefined
 from pdfminer.pdfpage import PDFPage
 from pdfminer.pdfinterp import PDFResourceManager
 from pdfminer.pdfinterp import PDFPageInterpreter
-from pdfminer.pdfdevice import PDFDevice
 from pdfminer.layout import LAParams
 from pdfminer.converter import PDFPageAggregator
 import pdfminer
@@ -14,10 +20,22 @@ import logging
 
 logger = logging.getLogger(__name__)
 HEADER_TOLERANCE = 20
-
-
-def get_pdf_transactions(path):
-    raw_row_data = get_text_rows(path)
+# Text of the first column heading of a page's transaction table.
+HEADER_TEXT = 'Date'
+# When laying out pages in parallel: pages handed to a worker at a time, and runs
+# queued per worker ahead of the consumer.
+PAGES_PER_TASK = 4
+TASKS_AHEAD = 2
+# Layout analysis settings that suit the bank's statements.
+LAYOUT_PARAMS = {
+    'line_overlap': 0.01,
+    'line_margin': 0.01,
+    'word_margin': 0.15,
+}
+
+
+def get_pdf_transactions(path, workers=None, cache=None, stats=None):
+    raw_row_data = get_text_rows(path, workers, cache, stats)
     pages = paginate_rows(raw_row_data)
     date_holder = [None]
     for page in pages:
@@ -113,7 +131,7 @@ def row_is_valid(*args):
 
 def extract_header_columns(page):
     for columns in page:
-        if 'Date' in columns[0][1]:
+        if HEADER_TEXT in columns[0][1]:
             break
     else:
         raise KeyError("No headers on this page")
@@ -122,77 +140,172 @@ def extract_header_columns(page):
 
 
 def paginate_rows(raw_rows):
-    page = []
-    page_id = -1
-    for row in raw_rows:
-        if page_id == -1:
-            page_id = row[0]
-        elif page_id != row[0]:
-            yield page
-            page = [row[2]]
-            page_id = row[0]
-        page.append(row[2])
-
-
-def get_text_rows(path):
-    rows = defaultdict(list)
-    # Open a PDF file.
-    fp = open(path, 'rb')
-
-    # Create a PDF parser object associated with the file object.
-    # parser = PDFParser(fp)
-
-    # Create a PDF document object that stores the document structure.
-    # Password for initialization as 2nd parameter
-    # document = PDFDocument(parser)
-
-    # Check if the document allows text extraction. If not, abort.
-    # if not document.is_extractable:
-    #     raise PDFTextExtractionNotAllowed
-
-    # Create a PDF resource manager object that stores shared resources.
-    rsrcmgr = PDFResourceManager()
-
-    # Create a PDF device object.
-    device = PDFDevice(rsrcmgr)
-
-    # BEGIN LAYOUT ANALYSIS
-    # Set parameters for analysis.
-    laparams = LAParams()
-    laparams.line_overlap = 0.01
-    laparams.line_margin = 0.01
-    laparams.word_margin = 0.15
-
-    # Create a PDF page aggregator object.
-    device = PDFPageAggregator(rsrcmgr, laparams=laparams)
-
-    # Create a PDF interpreter object.
-    interpreter = PDFPageInterpreter(rsrcmgr, device)
-
-    def parse_obj(lt_objs, page):
-        # loop over the object list
-        for obj in lt_objs:
-            # if it's a textbox, print text and location
-            if isinstance(obj, pdfminer.layout.LTTextBoxHorizontal):
-                rows[(page, -int(obj.bbox[1]))].append((int(obj.bbox[0]), sanitize(obj.get_text())))
-            # if it's a container, recurse
-            elif isinstance(obj, pdfminer.layout.LTFigure):
-                parse_obj(obj._objs, page)
-
-    # loop over all pages in the document
-    for page_num, page in enumerate(PDFPage.get_pages(fp)):
-        # read the page into a layout object
-        interpreter.process_page(page)
-        layout = device.get_result()
-
-        # extract text from this object
-        parse_obj(layout._objs, page_num)
+    # Groups the rows of each page, yielding a page as soon as the next one starts.
+    for _, rows in itertools.groupby(raw_rows, key=lambda row: row[0]):
+        yield [row[2] for row in rows]
+
+
+class PageStats(object):
+    def __init__(self):
+        self.analysed = 0
+        self.skipped = 0
+
+    def describe(self):
+        return 'Laid out {} of {} pages ({} skipped without a transaction table)'.format(
+            self.analysed, self.analysed + self.skipped, self.skipped)
+
+
+def get_text_rows(path, workers=None, cache=None, stats=None):
+    # Rows of text as (page, y, [(x, text), ...]), top to bottom and page by page.
+    # Each page is sorted and yielded as soon as it has been laid out. If a cache
+    # (e.g. a Connection) is given, a file laid out before is read back from it
+    # instead, and a fresh layout is stored in it once complete.
+    cache_key = None
+    if cache is not None:
+        cache_key = layout_cache_key(path)
+        cached = cache.get_layout(cache_key)
+        if cached is not None:
+            logger.info("Using cached layout of '%s'", path)
+            for page, y, cells in json.loads(cached):
+                yield (page, y, [tuple(cell) for cell in cells])
+            return
+
+    text_rows = []
+    stats = stats or PageStats()
+    for page, rows in iter_page_rows(path, workers):
+        if rows is None:
+            stats.skipped += 1
+            continue
+        stats.analysed += 1
+        for key in sorted(rows):
+            row = (page, -key, sorted(rows[key]))
+            if cache_key is not None:
+                text_rows.append(row)
+            yield row
+    logger.info("%s of '%s'", stats.describe(), path)
+    if cache_key is not None:
+        try:
+            cache.store_layout(cache_key, json.dumps(text_rows))
+        except Exception as e:
+            # The rows are good either way; only the next parse of this file is slower.
+            logger.warning("Failed to cache the layout of '%s': %s", path, e)
+
+
+def layout_cache_key(path):
+    # Identifies a layout by the file's content and everything that affects how it
+    # is laid out.
+    digest = hashlib.sha256()
+    settings = [pdfminer.__version__, LAYOUT_PARAMS, HEADER_TEXT]
+    digest.update(json.dumps(settings, sort_keys=True).encode('utf-8'))
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def iter_page_rows(path, workers=None):
+    # Layout analysis dominates parsing time, and each page is laid out independently,
+    # so with more than one worker the pages are farmed out to a pool of processes in
+    # small runs. Only a few runs are queued ahead of the consumer, and results are
+    # still yielded in page order.
+    workers = workers or os.cpu_count() or 1
+    page_count = count_pages(path) if workers > 1 else 1
+    if page_count <= 1:
+        yield from layout_pages(path)
+        return
 
-    for key in sorted(rows):
-        rows[key] = sorted(rows[key])
-        page, y = key
-        y = -y
-        yield (page, y, rows[key])
+    run_length = min(PAGES_PER_TASK, -(-page_count // workers))
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        pending = deque()
+        for start in range(0, page_count, run_length):
+            pages = list(range(start, min(start + run_length, page_count)))
+            pending.append(pool.submit(_layout_page_run, path, pages))
+            if len(pending) >= workers * TASKS_AHEAD:
+                yield from pending.popleft().result()
+        while len(pending) > 0:
+            yield from pending.popleft().result()
+
+
+def _layout_page_run(path, page_numbers):
+    return list(layout_pages(path, page_numbers))
+
+
+def count_pages(path):
+    with open(path, 'rb') as fp:
+        return sum(1 for _ in PDFPage.get_pages(fp))
+
+
+def layout_pages(path, page_numbers=None):
+    # Yields (page number, text boxes keyed by -y) for the given pages (all of them by
+    # default), one page at a time. Pages without a transaction table aren't laid
+    # out, and come with None in place of their text boxes.
+    page_numbers = None if page_numbers is None else set(page_numbers)
+    with open(path, 'rb') as fp:
+        # Create a PDF resource manager object that stores shared resources.
+        rsrcmgr = PDFResourceManager()
+
+        # BEGIN LAYOUT ANALYSIS
+        # Set parameters for analysis.
+        laparams = LAParams()
+        for name, value in LAYOUT_PARAMS.items():
+            setattr(laparams, name, value)
+
+        # Create a PDF page aggregator object.
+        device = PDFPageAggregator(rsrcmgr, laparams=laparams)
+
+        # Create a PDF interpreter object.
+        interpreter = PDFPageInterpreter(rsrcmgr, device)
+        scanner = _TextScanner(rsrcmgr)
+        scan_interpreter = PDFPageInterpreter(rsrcmgr, scanner)
+
+        def parse_obj(lt_objs, rows):
+            # loop over the object list
+            for obj in lt_objs:
+                # if it's a textbox, print text and location
+                if isinstance(obj, pdfminer.layout.LTTextBoxHorizontal):
+                    rows[-int(obj.bbox[1])].append((int(obj.bbox[0]), sanitize(obj.get_text())))
+                # if it's a container, recurse
+                elif isinstance(obj, pdfminer.layout.LTFigure):
+                    parse_obj(obj._objs, rows)
+
+        # get_pages() skips pages not in page_numbers without laying them out, but
+        # doesn't report their numbers, so walk the page numbers alongside.
+        selected = itertools.count() if page_numbers is None else sorted(page_numbers)
+        for page_num, page in zip(selected, PDFPage.get_pages(fp, pagenos=page_numbers)):
+            if not scanner.has_text(scan_interpreter, page, HEADER_TEXT):
+                yield page_num, None
+                continue
+
+            # read the page into a layout object
+            interpreter.process_page(page)
+
+            # extract text from this object; only the text is kept, so the page's
+            # layout can be freed before the next one is processed
+            rows = defaultdict(list)
+            parse_obj(device.get_result()._objs, rows)
+            yield page_num, dict(rows)
+
+
+class _TextScanner(PDFTextDevice):
+    # Collects a page's characters in content stream order, skipping the geometry and
+    # grouping of layout analysis. Text that layout analysis would find on the page
+    # shows up here too, so it's a cheap test of whether a page is worth laying out.
+    def __init__(self, rsrcmgr):
+        PDFTextDevice.__init__(self, rsrcmgr)
+        self.chars = []
+
+    def has_text(self, interpreter, page, text):
+        self.chars = []
+        interpreter.process_page(page)
+        return text in ''.join(self.chars)
+
+    def render_char(self, matrix, font, fontsize, scaling, rise, cid):
+        try:
+            self.chars.append(font.to_unichr(cid))
+        except PDFUnicodeNotDefined:
+            pass
+        # Character positions don't matter here.
+        return 0
 
 
 def sanitize(text):
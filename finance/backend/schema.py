@@ -0,0 +1,311 @@
+import hashlib
+import re
+
+
+# The schema as originally shipped. New databases are seeded with this and then
+# brought up to date by running every migration, so they match upgraded ones.
+BASE_SCHEMA = (
+    ('schema', (
+        ('hash', 'TEXT'),
+        ('version', 'INTEGER'),
+    )),
+    ('transactions', (
+        ('id', 'INTEGER PRIMARY KEY'),
+        ('timestamp', 'TIMESTAMP'),
+        ('description', 'TEXT'),
+        ('amount_pence', 'INTEGER'),
+        ('category_1', 'TEXT'),
+        ('category_2', 'TEXT'),
+        ('category_3', 'TEXT'),
+        ('notes', 'TEXT'),
+    )),
+)
+
+# Databases created before versioned migrations only recorded a hash of their schema.
+LEGACY_SCHEMA_VERSIONS = {
+    '35dd181e5d0e5885955c2aa61efee931': 0,
+    '34e51c74b3f6a6174d6079ede9cbb1d6': 1,
+}
+
+
+class Migration(object):
+    def __init__(self, version, description, steps):
+        self.version = version
+        self.description = description
+        self.steps = steps
+
+    def apply(self, c):
+        for step in self.steps:
+            if callable(step):
+                step(c)
+            else:
+                c.execute(step)
+
+    def describe(self):
+        lines = ['{}: {}'.format(self.version, self.description)]
+        for step in self.steps:
+            if callable(step):
+                lines.append('    [python] {}'.format(step.__name__))
+            else:
+                lines.append('    ' + ' '.join(step.split()))
+        return lines
+
+
+def dedup_key(epoch, description, amount_pence):
+    content = '{}|{}|{}'.format(epoch, description, amount_pence)
+    return hashlib.sha1(content.encode('utf-8')).hexdigest()
+
+
+def canonical_merchant(description):
+    # The merchant a bank description names, without the card numbers, references
+    # and dates that change from one transaction to the next.
+    words = [word for word in re.split(r'[\s*/-]+', description)
+             if len(word) > 0 and not any(ch.isdigit() for ch in word)]
+    return ' '.join(words).upper() or description
+
+
+def _backfill_dedup_keys(c):
+    rows = c.execute('SELECT id, timestamp, description, amount_pence FROM transactions').fetchall()
+    c.executemany('UPDATE transactions SET dedup_key=? WHERE id=?',
+                  [(dedup_key(*row[1:]), row[0]) for row in rows])
+
+
+def _create_fulltext_index(c):
+    # Substring search needs FTS5's trigram tokenizer (SQLite 3.34+). Builds without
+    # it skip the index, and text filters fall back to LIKE.
+    fts5 = c.execute("SELECT sqlite_compileoption_used('ENABLE_FTS5')").fetchone()[0]
+    version = c.execute('SELECT sqlite_version()').fetchone()[0]
+    if not fts5 or tuple(int(part) for part in version.split('.')[:2]) < (3, 34):
+        return
+
+    c.execute('''CREATE VIRTUAL TABLE transactions_fts USING fts5(
+                     description, notes,
+                     content='transactions', content_rowid='id', tokenize='trigram')''')
+    c.execute('''CREATE TRIGGER transactions_fts_insert AFTER INSERT ON transactions BEGIN
+                     INSERT INTO transactions_fts (rowid, description, notes)
+                     VALUES (new.id, new.description, new.notes);
+                 END''')
+    c.execute('''CREATE TRIGGER transactions_fts_delete AFTER DELETE ON transactions BEGIN
+                     INSERT INTO transactions_fts (transactions_fts, rowid, description, notes)
+                     VALUES ('delete', old.id, old.description, old.notes);
+                 END''')
+    c.execute('''CREATE TRIGGER transactions_fts_update AFTER UPDATE OF description, notes ON transactions BEGIN
+                     INSERT INTO transactions_fts (transactions_fts, rowid, description, notes)
+                     VALUES ('delete', old.id, old.description, old.notes);
+                     INSERT INTO transactions_fts (rowid, description, notes)
+                     VALUES (new.id, new.description, new.notes);
+                 END''')
+    c.execute("INSERT INTO transactions_fts (transactions_fts) VALUES ('rebuild')")
+
+
+# Category columns of the transactions table: names up to version 4, then keys
+# into the categories table.
+_CATEGORY_NAMES = ('category_1', 'category_2', 'category_3')
+CATEGORY_IDS = ('category_1_id', 'category_2_id', 'category_3_id')
+
+
+def _month_sql(row):
+    return "strftime('%Y-%m', {}.timestamp / 1000000, 'unixepoch')".format(row)
+
+
+def _bucket_sql(row, columns):
+    # quote() keeps NULL and '' categories in separate buckets.
+    return " || '|' || ".join([_month_sql(row)] + ['quote({}.{})'.format(row, col) for col in columns])
+
+
+def _add_to_monthly_totals_sql(row, columns):
+    return '''INSERT OR IGNORE INTO monthly_totals
+                  (bucket, month, {cols}, total_pence, tx_count)
+              VALUES ({bucket}, {month}, {row_cols}, 0, 0);
+              UPDATE monthly_totals
+              SET total_pence = total_pence + {row}.amount_pence, tx_count = tx_count + 1
+              WHERE bucket = {bucket};'''.format(
+        bucket=_bucket_sql(row, columns), month=_month_sql(row), row=row, cols=', '.join(columns),
+        row_cols=', '.join('{}.{}'.format(row, col) for col in columns))
+
+
+def _remove_from_monthly_totals_sql(row, columns):
+    return '''UPDATE monthly_totals
+              SET total_pence = total_pence - {row}.amount_pence, tx_count = tx_count - 1
+              WHERE bucket = {bucket};
+              DELETE FROM monthly_totals WHERE bucket = {bucket} AND tx_count = 0;'''.format(
+        bucket=_bucket_sql(row, columns), row=row)
+
+
+def _monthly_totals_query(columns):
+    # The materialized totals, as computed from scratch from the transactions table.
+    return '''SELECT {bucket}, {month}, {cols}, SUM(amount_pence), COUNT(*)
+              FROM transactions
+              GROUP BY 1'''.format(
+        bucket=_bucket_sql('transactions', columns), month=_month_sql('transactions'), cols=', '.join(columns))
+
+
+MONTHLY_TOTALS_QUERY = _monthly_totals_query(CATEGORY_IDS)
+
+
+def _create_monthly_totals_table(c, columns, column_type):
+    c.execute('''CREATE TABLE monthly_totals (
+                     bucket TEXT PRIMARY KEY,
+                     month TEXT,
+                     {},
+                     total_pence INTEGER,
+                     tx_count INTEGER)'''.format(', '.join('{} {}'.format(col, column_type) for col in columns)))
+    c.execute('CREATE INDEX monthly_totals_month ON monthly_totals (month)')
+    c.execute('INSERT INTO monthly_totals ' + _monthly_totals_query(columns))
+    c.execute('''CREATE TRIGGER monthly_totals_insert AFTER INSERT ON transactions BEGIN
+                     {}
+                 END'''.format(_add_to_monthly_totals_sql('new', columns)))
+    c.execute('''CREATE TRIGGER monthly_totals_delete AFTER DELETE ON transactions BEGIN
+                     {}
+                 END'''.format(_remove_from_monthly_totals_sql('old', columns)))
+    c.execute('''CREATE TRIGGER monthly_totals_update
+                 AFTER UPDATE OF timestamp, amount_pence, {} ON transactions BEGIN
+                     {}
+                     {}
+                 END'''.format(', '.join(columns), _remove_from_monthly_totals_sql('old', columns),
+                                _add_to_monthly_totals_sql('new', columns)))
+
+
+def _create_monthly_totals(c):
+    _create_monthly_totals_table(c, _CATEGORY_NAMES, 'TEXT')
+
+
+def _merchant_name_sql(row):
+    return '(SELECT name FROM merchants WHERE merchants.id = {}.merchant_id)'.format(row)
+
+
+def _category_name_sql(row, column):
+    return '(SELECT name FROM categories WHERE categories.id = {}.{})'.format(row, column)
+
+
+def _rebuild_transactions_with_ids(c):
+    # SQLite can't change a column's type in place, so copy into a new table. Dropping
+    # the old one also drops its indexes and the triggers maintaining the full-text
+    # index and monthly totals; later steps recreate them.
+    c.execute('''CREATE TABLE transactions_new (
+                     id INTEGER PRIMARY KEY,
+                     timestamp TIMESTAMP,
+                     merchant_id INTEGER REFERENCES merchants (id),
+                     amount_pence INTEGER,
+                     category_1_id INTEGER REFERENCES categories (id),
+                     category_2_id INTEGER REFERENCES categories (id),
+                     category_3_id INTEGER REFERENCES categories (id),
+                     notes TEXT,
+                     dedup_key TEXT)''')
+    c.execute('''INSERT INTO transactions_new
+                 SELECT id, timestamp,
+                        (SELECT id FROM merchants WHERE name = description),
+                        amount_pence,
+                        (SELECT id FROM categories WHERE name = category_1),
+                        (SELECT id FROM categories WHERE name = category_2),
+                        (SELECT id FROM categories WHERE name = category_3),
+                        notes, dedup_key
+                 FROM transactions''')
+    c.execute('DROP TABLE transactions')
+    c.execute('ALTER TABLE transactions_new RENAME TO transactions')
+
+
+def _create_transaction_details(c):
+    # Transactions as the rest of the code sees them, with names in place of keys.
+    c.execute('''CREATE VIEW transaction_details AS
+                 SELECT id, timestamp, {description} AS description, amount_pence,
+                        {category_1} AS category_1, {category_2} AS category_2, {category_3} AS category_3,
+                        notes, dedup_key, merchant_id, category_1_id, category_2_id, category_3_id
+                 FROM transactions'''.format(
+        description=_merchant_name_sql('transactions'),
+        **{col: _category_name_sql('transactions', col + '_id') for col in _CATEGORY_NAMES}))
+
+
+def _recreate_fulltext_index(c):
+    if c.execute("SELECT COUNT(*) FROM sqlite_master WHERE name='transactions_fts'").fetchone()[0] == 0:
+        return
+    c.execute('DROP TABLE transactions_fts')
+    c.execute('''CREATE VIRTUAL TABLE transactions_fts USING fts5(
+                     description, notes,
+                     content='transaction_details', content_rowid='id', tokenize='trigram')''')
+    c.execute('''CREATE TRIGGER transactions_fts_insert AFTER INSERT ON transactions BEGIN
+                     INSERT INTO transactions_fts (rowid, description, notes)
+                     VALUES (new.id, {new}, new.notes);
+                 END'''.format(new=_merchant_name_sql('new')))
+    c.execute('''CREATE TRIGGER transactions_fts_delete AFTER DELETE ON transactions BEGIN
+                     INSERT INTO transactions_fts (transactions_fts, rowid, description, notes)
+                     VALUES ('delete', old.id, {old}, old.notes);
+                 END'''.format(old=_merchant_name_sql('old')))
+    c.execute('''CREATE TRIGGER transactions_fts_update AFTER UPDATE OF merchant_id, notes ON transactions BEGIN
+                     INSERT INTO transactions_fts (transactions_fts, rowid, description, notes)
+                     VALUES ('delete', old.id, {old}, old.notes);
+                     INSERT INTO transactions_fts (rowid, description, notes)
+                     VALUES (new.id, {new}, new.notes);
+                 END'''.format(old=_merchant_name_sql('old'), new=_merchant_name_sql('new')))
+    c.execute("INSERT INTO transactions_fts (transactions_fts) VALUES ('rebuild')")
+
+
+def _backfill_canonical_merchants(c):
+    rows = c.execute('SELECT id, name FROM merchants').fetchall()
+    c.executemany('UPDATE merchants SET canonical=? WHERE id=?',
+                  [(canonical_merchant(name), merchant_id) for merchant_id, name in rows])
+
+
+def _recreate_monthly_totals(c):
+    c.execute('DROP TABLE monthly_totals')
+    _create_monthly_totals_table(c, CATEGORY_IDS, 'INTEGER')
+
+
+# Append only: never edit or reorder a migration once it has shipped.
+MIGRATIONS = (
+    Migration(1, 'Add content-hash dedup key to transactions', (
+        'ALTER TABLE transactions ADD COLUMN dedup_key TEXT',
+        _backfill_dedup_keys,
+        'CREATE UNIQUE INDEX transactions_dedup_key ON transactions (dedup_key)',
+    )),
+    Migration(2, 'Index transactions by timestamp and by category', (
+        'CREATE INDEX IF NOT EXISTS transactions_timestamp ON transactions (timestamp)',
+        # Leading with the categories serves Filter.category and Filter.untagged, and
+        # covers the DISTINCT tag listing without touching the table itself.
+        '''CREATE INDEX IF NOT EXISTS transactions_category
+           ON transactions (category_1, category_2, category_3, timestamp)''',
+    )),
+    Migration(3, 'Add full-text index over transaction descriptions and notes', (
+        _create_fulltext_index,
+    )),
+    Migration(4, 'Add trigger-maintained monthly totals by category', (
+        _create_monthly_totals,
+    )),
+    Migration(5, 'Store categories and merchants as keys into lookup tables', (
+        'CREATE TABLE categories (id INTEGER PRIMARY KEY, name TEXT NOT NULL UNIQUE)',
+        'CREATE TABLE merchants (id INTEGER PRIMARY KEY, name TEXT NOT NULL UNIQUE)',
+        '''INSERT INTO categories (name)
+           SELECT category_1 FROM transactions WHERE category_1 IS NOT NULL
+           UNION SELECT category_2 FROM transactions WHERE category_2 IS NOT NULL
+           UNION SELECT category_3 FROM transactions WHERE category_3 IS NOT NULL''',
+        'INSERT INTO merchants (name) SELECT DISTINCT description FROM transactions WHERE description IS NOT NULL',
+        _rebuild_transactions_with_ids,
+        'CREATE UNIQUE INDEX transactions_dedup_key ON transactions (dedup_key)',
+        'CREATE INDEX transactions_timestamp ON transactions (timestamp)',
+        '''CREATE INDEX transactions_category
+           ON transactions (category_1_id, category_2_id, category_3_id, timestamp)''',
+        _create_transaction_details,
+        _recreate_fulltext_index,
+        _recreate_monthly_totals,
+    )),
+    Migration(6, 'Add cache of PDF statement layouts', (
+        '''CREATE TABLE layout_cache (
+               key TEXT PRIMARY KEY,
+               rows TEXT,
+               size INTEGER,
+               last_used INTEGER)''',
+    )),
+    # Raw descriptions stay as they are, so Transaction.description is unchanged;
+    # the canonical name groups the merchants that only differ by references.
+    Migration(7, 'Add canonical names to merchants', (
+        'ALTER TABLE merchants ADD COLUMN canonical TEXT',
+        _backfill_canonical_merchants,
+        'CREATE INDEX merchants_canonical ON merchants (canonical)',
+    )),
+    # Description and merchant filters pick merchants first, then their transactions.
+    Migration(8, 'Index transactions by merchant', (
+        'CREATE INDEX transactions_merchant ON transactions (merchant_id)',
+    )),
+)
+
+LATEST_VERSION = MIGRATIONS[-1].version
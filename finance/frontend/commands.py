@@ -12,42 +12,43 @@ commands = None
 
 
 def _show_all(view):
-    txs = sorted(view.db_context, key=lambda tx: tx.timestamp)
-    lines = list(format_transactions(txs, max_width=view.get_max_content_width()))
-    lines.append('--- {} transactions ---'.format(len(lines)))
-    lines.append('')
-    return lines
+    db_context = view.db_context.order_by('timestamp', 'id')
+    count = len(db_context)
+    if count > view.get_listing_height():
+        # Too long to show at once: let the pane fetch one screen at a time instead.
+        view.show_listing(db_context)
+    else:
+        lines = list(format_transactions(list(db_context), max_width=view.get_max_content_width()))
+        view.write_lines(lines)
+    return ['--- {} transactions ---'.format(count), '']
 
 
 def _list_tags(view):
-    tags = view.db_context.db.select_raw('''SELECT DISTINCT category_1, category_2, category_3 FROM transactions''', tuple())
+    tags = view.db_context.db.select_raw('''SELECT c1.name, c2.name, c3.name
+                                            FROM (SELECT DISTINCT category_1_id, category_2_id, category_3_id
+                                                  FROM transactions) AS tags
+                                            LEFT JOIN categories AS c1 ON c1.id = tags.category_1_id
+                                            LEFT JOIN categories AS c2 ON c2.id = tags.category_2_id
+                                            LEFT JOIN categories AS c3 ON c3.id = tags.category_3_id''', tuple())
     lines = sorted([format_category(tag) for tag in tags])
     lines.append('')
     return lines
 
 
 def _tag_all(view, *categories):
-    categories = list(categories)
-    count = len(view.db_context)
-    tag = format_category(categories)
-    if len(categories) < 3:
-        categories.extend([None] * (3 - len(categories)))
-
-    txs = list(view.db_context)  # Read all the transactions first to avoid modifying while iterating
-    for tx in txs:
-        tx.category_1, tx.category_2, tx.category_3 = categories
-        view.db_context.db.store_transaction(tx)
-
+    count = view.db_context.update_categories(*categories)
     return ['Updated {} transactions'.format(count)]
 
 
 def _tag(view, tid, *categories):
     categories = list(categories)
-    matches = list(view.db_context.db.fetch_transactions('id=?', (tid,)))
-    if len(matches) == 0:
+    try:
+        tx = view.db_context.db.fetch_transaction(int(tid))
+    except ValueError:
+        tx = None
+    if tx is None:
         return ['ERROR: Transaction #{} not found'.format(tid)]
     else:
-        tx = matches[0]
         if len(categories) < 3:
             categories.extend([None] * (3 - len(categories)))
         tx.category_1, tx.category_2, tx.category_3 = categories
@@ -66,7 +67,8 @@ def _filter_tag(view, *tags):
 
 
 def _filter_text(view, term):
-    view.db_context = view.db_context.filter(Filter.description(term))
+    indexed = view.db_context.db.has_fulltext_index
+    view.db_context = view.db_context.filter(Filter.text_search(term, indexed=indexed))
     return get_filter_status(view.db_context)
 
 
@@ -95,18 +97,21 @@ def _filter_date_after(view, start_date):
 
 
 def _summary(view):
-    txs = list(view.db_context)
+    groups = view.db_context.aggregate(level=3, aggregates=('sum',))
+    if len(groups) == 0:
+        return ['=> No transactions to summarise', '']
+
     split_idx = 1
-    for field in ['category_1', 'category_2', 'category_3']:
-        distinct_values = set(getattr(tx, field) for tx in txs)
+    for level in range(3):
+        distinct_values = set(group[level] for group in groups)
         if len(distinct_values) > 1:
             break
         split_idx += 1
 
     summary = defaultdict(int)
-    for tx in txs:
-        category = format_category([tx.category_1, tx.category_2, tx.category_3][:split_idx])
-        summary[category] += tx.amount_pence
+    for group in groups:
+        categories, total = group[:3], group[3]
+        summary[format_category(categories[:split_idx])] += total
 
     category_size = max(len(c) for c in summary)
     lines = []
@@ -119,6 +124,52 @@ def _summary(view):
     return lines
 
 
+def _months(view):
+    lines = []
+    for month, total, count in view.db_context.db.monthly_totals():
+        lines.append('{}  {:>12}  ({} transactions)'.format(month, format_sum(total), count))
+    lines.append('')
+    return lines
+
+
+def _rebuild_totals(view):
+    repaired = view.db_context.db.rebuild_monthly_totals()
+    if repaired == 0:
+        return ['=> Monthly totals are consistent', '']
+    return ['=> Rebuilt monthly totals ({} inconsistent entries)'.format(repaired), '']
+
+
+def _explain(view):
+    lines = ['=> Query plan:']
+    lines.extend('   ' + step for step in view.db_context.explain())
+    lines.append('')
+    return lines
+
+
+def _stats(view, action=None):
+    db = view.db_context.db
+    if action == 'on':
+        db.enable_query_stats()
+        return ['=> Query stats enabled', '']
+    elif action == 'off':
+        db.disable_query_stats()
+        return ['=> Query stats disabled', '']
+    elif action == 'reset':
+        if db.query_stats is not None:
+            db.query_stats.reset()
+        return ['=> Query stats reset', '']
+    elif action is not None:
+        return ['ERROR: Unknown stats action "{}" - expected on, off or reset'.format(action), '']
+
+    lines = ['=> ' + db.result_cache.describe()]
+    if db.query_stats is None:
+        lines.append("=> Query stats are disabled; enable them with 'stats on'")
+    else:
+        lines.extend(db.query_stats.report(limit=20))
+    lines.append('')
+    return lines
+
+
 def _reset(view):
     view.db_context = view.original_db_context
     return [
@@ -152,16 +203,17 @@ def format_transaction(transaction):
     )
 
 
-def format_transactions(txs, max_width=-1):
+def format_transactions(txs, max_width=-1, col_lengths=None):
     if len(txs) == 0:
         return []
 
     max_field_width = int(max_width / 4) if max_width > 0 else 9999999999
 
     tx_rows = [format_transaction(t) for t in txs]
-    col_lengths = []
-    for idx in range(len(tx_rows[0])):
-        col_lengths.append(min(max_field_width, max(len(row[idx]) for row in tx_rows)))
+    if col_lengths is None:
+        col_lengths = []
+        for idx in range(len(tx_rows[0])):
+            col_lengths.append(min(max_field_width, max(len(row[idx]) for row in tx_rows)))
 
     results = []
     for row in tx_rows:
@@ -175,6 +227,21 @@ def format_transactions(txs, max_width=-1):
     return results
 
 
+def listing_column_widths(db_context, max_width):
+    # Column widths for a whole view, worked out from its extremes rather than by
+    # formatting every row, so that a listing doesn't shift as it is scrolled.
+    max_field_width = int(max_width / 4)
+    max_id = db_context.max('id') or 0
+    amounts = [db_context.min('amount_pence') or 0, db_context.max('amount_pence') or 0]
+    return [
+        len(str(max_id)),
+        len('YYYY-MM-DD'),
+        max(len(format_sum(amount)) for amount in amounts),
+        max_field_width,
+        max_field_width,
+    ]
+
+
 def parse_date(date_str):
     return datetime.datetime.strptime(date_str, '%Y-%m-%d')
 
@@ -228,5 +295,9 @@ class Commands(object):
         self.filter_date_after = Command(1, 2, _filter_date_after)
         self.filter_text = Command(1, 2, _filter_text)
         self.summary = Command(0, 1, _summary)
+        self.explain = Command(0, 1, _explain)
+        self.months = Command(0, 1, _months)
+        self.rebuild_totals = Command(0, 1, _rebuild_totals)
+        self.stats = Command(0, 2, _stats)
         self.reset = Command(0, 1, _reset)
 commands = Commands()
@@ -1,11 +1,9 @@
 import curses
-import datetime
 import logging
 import textwrap
 import time
 from dateutil.relativedelta import relativedelta
-from .commands import commands
-from ..backend import Filter
+from .commands import commands, format_transactions, listing_column_widths
 
 
 logger = logging.getLogger(__name__)
@@ -121,16 +119,15 @@ class Ui(object):
                     pane.write_line("ERROR: You are already in a split. Call 'split reset' first")
                 return True, True
             num_months = int(command.split()[-1])
-            latest_transaction = list(sorted(self.view_panes[0].db_context, key=lambda tx: tx.timestamp))[-1]
-            transaction_month = latest_transaction.timestamp.replace(day=1, hour=1, minute=1, second=1)
-            start_date = transaction_month - relativedelta(months=num_months)
-            end_date = start_date + relativedelta(months=1) - datetime.timedelta(days=1)
+            latest_timestamp = self.view_panes[0].db_context.max('timestamp')
+            if latest_timestamp is None:
+                self.view_panes[0].write_line("ERROR: No transactions to split")
+                return True, True
+            latest_month = latest_timestamp.replace(day=1)
             db_contexts = []
-            for _ in range(num_months):
-                start_date += relativedelta(months=1)
-                end_date += relativedelta(months=1)
-                db_context = self.view_panes[0].db_context.filter(Filter.date_range(start_date, end_date))
-                db_contexts.append(db_context)
+            for offset in range(num_months - 1, -1, -1):
+                month = latest_month - relativedelta(months=offset)
+                db_contexts.append(self.view_panes[0].db_context.month(month.year, month.month))
             self.refresh_view_panes(db_contexts)
             return True, True
         else:
@@ -189,13 +186,50 @@ class InputPane(object):
         return flushed
 
 
+class Listing(object):
+    # A window onto a view's transactions in (timestamp, id) order. Only the visible
+    # rows are held; scrolling fetches the next few with keyset pagination.
+    def __init__(self, db_context, height, width):
+        self.db_context = db_context
+        self.height = height
+        self.col_lengths = listing_column_widths(db_context, width)
+        # Rows are cut to the pane's width less its border, where the scrollback
+        # would wrap them, so that each row stays on its own line.
+        self.line_width = width - 4
+        # Start at the end, as if the whole view had been written to the scrollback.
+        self.rows = db_context.page_before(None, height)
+
+    def scroll_down(self, num_lines):
+        if len(self.rows) > 0:
+            later = self.db_context.page_after(_page_key(self.rows[-1]), num_lines)
+            self.rows = (self.rows + later)[-self.height:]
+
+    def scroll_up(self, num_lines):
+        if len(self.rows) > 0:
+            earlier = self.db_context.page_before(_page_key(self.rows[0]), num_lines)
+            self.rows = (earlier + self.rows)[:self.height]
+
+    def render(self):
+        lines = format_transactions(self.rows, col_lengths=self.col_lengths)
+        lines.append('--- {} transactions ---'.format(len(self.db_context)))
+        return [line[:self.line_width] for line in lines]
+
+
+def _page_key(tx):
+    return (tx.epoch, tx.tid)
+
+
 class ViewPane(object):
+    # Rendered lines kept for scrolling back; older ones are dropped.
+    max_scrollback = 5000
+
     def __init__(self, window, db_context):
         self.window = window
         self.lines = []
         self.scrollback = []
         self.scroll = 0
         self.max_scroll = 0
+        self.listing = None
         self.db_context = db_context
         self.original_db_context = db_context
         self.commands = self.register_commands()
@@ -213,11 +247,21 @@ class ViewPane(object):
             'filter date': commands.filter_date,
             'filter': commands.filter_text,
             'summary': commands.summary,
+            'explain': commands.explain,
+            'months': commands.months,
+            'rebuild totals': commands.rebuild_totals,
+            'stats': commands.stats,
             'reset': commands.reset,
         }
 
     def repaint(self):
-        if self.window is not None:
+        if self.window is not None and self.listing is not None:
+            self.window.erase()
+            self.window.border(0, 0, ' ', ' ')
+            for idx, line in enumerate(self.listing.render()):
+                self.window.addstr(idx, 2, line)
+            self.window.refresh()
+        elif self.window is not None:
             height, _ = self.window.getmaxyx()
             self.window.erase()
             self.window.border(0, 0, ' ', ' ')
@@ -238,6 +282,15 @@ class ViewPane(object):
     def get_max_content_width(self):
         return self.window.getmaxyx()[1]
 
+    def get_listing_height(self):
+        # One line of the frame is left for the listing's footer.
+        return self.window.getmaxyx()[0] - 2
+
+    def show_listing(self, db_context):
+        # Until the next command, the pane shows a scrollable window onto db_context
+        # in place of its scrollback.
+        self.listing = Listing(db_context, self.get_listing_height(), self.get_max_content_width())
+
     def rebind(self, window):
         logger.info("Rebinding ViewPane '%r' to window '%r'", self, window)
         if self.window is not None:
@@ -248,6 +301,7 @@ class ViewPane(object):
             window.erase()
 
         self.window = window
+        self.listing = None
         lines = self.lines
         self.lines, self.scrollback = [], []
         self.scroll, self.max_scroll = 0, 0
@@ -276,14 +330,26 @@ class ViewPane(object):
                 to_scroll = len(rendered_lines)
                 self.max_scroll += to_scroll
                 self.scroll += to_scroll
+            excess = len(self.scrollback) - self.max_scrollback
+            if excess > 0:
+                del self.scrollback[:excess]
+                self.max_scroll -= excess
+                self.scroll = max(1, self.scroll - excess)
             self.repaint()
+        del self.lines[:-self.max_scrollback]
 
     def scroll_down(self, num_lines):
-        self.scroll = min(self.max_scroll, self.scroll + num_lines)
+        if self.listing is not None:
+            self.listing.scroll_down(num_lines)
+        else:
+            self.scroll = min(self.max_scroll, self.scroll + num_lines)
         self.repaint()
 
     def scroll_up(self, num_lines):
-        self.scroll = max(1, self.scroll - num_lines)
+        if self.listing is not None:
+            self.listing.scroll_up(num_lines)
+        else:
+            self.scroll = max(1, self.scroll - num_lines)
         self.repaint()
 
     def reset_scroll(self):
@@ -291,6 +357,7 @@ class ViewPane(object):
         self.repaint()
 
     def handle_command(self, command):
+        self.listing = None
         if len(command) == 0:
             self.write_line(' ')
             return
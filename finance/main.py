@@ -1,16 +1,28 @@
 from curses import wrapper
 import datetime
+import glob
+import json
 import logging.config
 import os
-import shutil
 import sys
+import time
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
 from getpass import getpass
 from .backend import Connection, Transaction, get_csv_transactions, get_pdf_transactions
+from .backend import daemon, pdf_parser
 from .frontend import Ui
 
 
 logger = logging.getLogger(__name__)
 
+# Number of backups kept: '<db>.bak' is the newest, then '<db>.bak.1' and so on.
+BACKUP_GENERATIONS = 3
+
+STATEMENT_EXTENSIONS = ('.csv', '.pdf')
+# Parsed statements queued per worker ahead of the database writer.
+INGEST_QUEUE_DEPTH = 2
+
 
 def init_logging():
     log_file_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'logging.conf')
@@ -18,10 +30,60 @@ def init_logging():
     logger.info("Finance starting up - logging initialized")
 
 
-def back_up_db(dbfile):
+def back_up_db(db, dbfile):
+    start = time.perf_counter()
     db_backup = dbfile + '.bak'
+    stamp_file = db_backup + '.stamp'
+    stat = os.stat(dbfile)
+    stamp = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+    if os.path.exists(db_backup) and _read_backup_stamp(stamp_file) == stamp:
+        logger.info("'%s' is unchanged since its last backup; skipping backup", dbfile)
+        return
+
     logger.info("Backing up '%s' to '%s'", dbfile, db_backup)
-    shutil.copyfile(dbfile, db_backup)
+    # Only rotate the older backups once the new one is complete.
+    try:
+        db.backup(db_backup + '.tmp')
+    except BaseException:
+        if os.path.exists(db_backup + '.tmp'):
+            os.remove(db_backup + '.tmp')
+        raise
+    for generation in range(BACKUP_GENERATIONS - 1, 0, -1):
+        older = _backup_path(dbfile, generation - 1)
+        if os.path.exists(older):
+            os.replace(older, _backup_path(dbfile, generation))
+    os.replace(db_backup + '.tmp', db_backup)
+    with open(stamp_file, 'w') as f:
+        json.dump(stamp, f)
+    logger.info("Backed up '%s' in %.3fs", dbfile, time.perf_counter() - start)
+
+
+def _backup_path(dbfile, generation):
+    return dbfile + '.bak' + ('.{}'.format(generation) if generation > 0 else '')
+
+
+def _read_backup_stamp(stamp_file):
+    try:
+        with open(stamp_file) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def open_db(db_file):
+    # Reuse the unlocked session of a running daemon if there is one, rather than
+    # paying for key derivation again.
+    if daemon.is_running(db_file):
+        logger.info("Using finance daemon for '%s'", db_file)
+        db = daemon.RemoteConnection(db_file)
+    else:
+        key = getpass('Password: ')
+        db = Connection(db_file, key)
+    # Back up before migrating, so a failed migration can always be undone.
+    db.connect(migrate=False)
+    back_up_db(db, db_file)
+    db.migrate()
+    return db
 
 
 def add_test_data(db):
@@ -45,40 +107,258 @@ def add_test_data(db):
 def repl():
     init_logging()
     db_file = sys.argv[1]
-    back_up_db(db_file)
-    key = getpass('Password: ')
-    db = Connection(db_file, key)
-    db.connect()
+    db = open_db(db_file)
     if len(db.as_view()) == 0:
         logger.info("Adding test data to empty database")
         add_test_data(db)
     logger.info("Starting REPL environment")
-    ui = Ui(db)
-    wrapper(ui.run)
+    run_session(db_file, db, lambda db: wrapper(Ui(db).run))
+
+
+def run_session(db_file, db, run_ui):
+    # Runs the UI until it exits. If the daemon the session was using goes away, the
+    # session carries on with the database unlocked locally instead.
+    while True:
+        try:
+            run_ui(db)
+            return
+        except daemon.DaemonGone as e:
+            logger.warning("Lost the finance daemon: %s", e)
+            print('The finance daemon has locked; unlock the database to continue.')
+            db = open_db(db_file)
 
 
 def ingest_file():
     init_logging()
-    db_file, path = sys.argv[1:]
-    back_up_db(db_file)
-    logger.info("Starting file ingest for file at '%s'", path)
-    key = getpass('Password: ')
-    db = Connection(db_file, key)
-    db.connect()
+    args = sys.argv[1:]
+    # --workers=N sets how many processes parse statements (default: one per CPU).
+    workers = [int(arg.split('=', 1)[1]) for arg in args if arg.startswith('--workers=')]
+    workers = workers[-1] if len(workers) > 0 else os.cpu_count() or 1
+    args = [arg for arg in args if not arg.startswith('--workers=')]
+    if len(args) < 2:
+        print('Usage: finance-store <db file> <statement, glob or directory>... [--workers=N]')
+        sys.exit(1)
+    db_file = args[0]
+    paths, unmatched = expand_statement_paths(args[1:])
+    summary = [(arg, 'FAILED: no matches') for arg in unmatched]
+    if len(paths) > 0:
+        logger.info("Starting file ingest for %d file(s)", len(paths))
+        # One unlock and one backup for the whole run.
+        db = open_db(db_file)
+        summary += ingest_statements(db, paths, workers)
+
+    path_width = max(len(path) for path, _ in summary)
+    for path, outcome in summary:
+        print('{}  {}'.format(path.ljust(path_width), outcome))
+    if any(outcome.startswith('FAILED') for _, outcome in summary):
+        sys.exit(1)
+
+
+def ingest_statements(db, paths, workers):
+    # Parses and stores each statement, returning (path, outcome) for every one of
+    # them. A statement that can't be parsed or stored doesn't stop the others.
+    summary = []
+    for path, result in parse_statements(db, paths, workers):
+        if isinstance(result, Exception):
+            logger.error("Failed to import '%s': %s", path, result)
+            summary.append((path, 'FAILED: {}'.format(result)))
+            continue
+        txs, layout = result
+        logger.info("Imported %d transactions from '%s'", len(txs), path)
+        try:
+            inserted, skipped = db.store_transactions(txs)
+        except Exception as e:
+            logger.exception("Failed to store transactions from '%s'", path)
+            summary.append((path, 'FAILED: {}'.format(e)))
+            continue
+        logger.info("Stored %d transactions successfully (%d duplicates skipped)", inserted, skipped)
+        summary.append((path, 'Stored {} new transactions ({} duplicates skipped)'.format(inserted, skipped)))
+        if layout is not None:
+            try:
+                db.store_layout(*layout)
+            except Exception as e:
+                # Only the cache is affected; the statement is stored all the same.
+                logger.warning("Failed to cache the layout of '%s': %s", path, e)
+    return summary
+
+
+def expand_statement_paths(args):
+    # Each argument is a statement, a glob, or a directory of statements. Files are
+    # taken in sorted order, and only once each. Returns the files, and the globs and
+    # directories that didn't match any.
+    paths = []
+    unmatched = []
+    for arg in args:
+        if os.path.isdir(arg):
+            matches = sorted(os.path.join(arg, name) for name in os.listdir(arg)
+                             if name.endswith(STATEMENT_EXTENSIONS))
+        elif any(c in arg for c in '*?['):
+            matches = sorted(glob.glob(arg))
+        else:
+            matches = [arg]
+        if len(matches) == 0:
+            logger.warning("No statements match '%s'", arg)
+            unmatched.append(arg)
+        for path in matches:
+            if path not in paths:
+                paths.append(path)
+    return paths, unmatched
+
+
+def parse_statements(db, paths, workers):
+    # Yields (path, (transactions, layout to cache) or the exception raised) in the
+    # order given. Several statements are parsed at once in worker processes, while
+    # the caller writes to the database from this one. At most a few results are
+    # queued ahead of the writer.
+    if len(paths) == 1 or workers == 1:
+        for path in paths:
+            try:
+                # Serially, a PDF's pages can be laid out in parallel instead.
+                yield path, (parse_statement(path, workers, cache=db), None)
+            except Exception as e:
+                yield path, e
+        return
+
+    with ProcessPoolExecutor(max_workers=min(workers, len(paths))) as pool:
+        pending = deque()
+        for path in paths:
+            try:
+                layout = _cached_layout(db, path)
+            except Exception as e:
+                failed = Future()
+                failed.set_exception(e)
+                pending.append((path, failed))
+            else:
+                pending.append((path, pool.submit(_parse_statement_in_worker, path, layout)))
+            if len(pending) >= workers * INGEST_QUEUE_DEPTH:
+                yield _parse_result(*pending.popleft())
+        while len(pending) > 0:
+            yield _parse_result(*pending.popleft())
 
+
+def _cached_layout(db, path):
+    # Worker processes can't share the connection, so the cached layout is looked up
+    # here, and any new one is stored from here too.
+    if not path.endswith('.pdf') or not os.path.isfile(path):
+        return None
+    key = pdf_parser.layout_cache_key(path)
+    return (key, db.get_layout(key))
+
+
+def parse_statement(path, workers=None, cache=None):
     if path.endswith('.csv'):
-        logger.info("Performing CSV import")
-        txs = list(get_csv_transactions(path))
+        logger.info("Performing CSV import of '%s'", path)
+        return list(get_csv_transactions(path))
     elif path.endswith('.pdf'):
-        logger.info("Performing PDF import")
-        txs = list(get_pdf_transactions(path))
+        logger.info("Performing PDF import of '%s'", path)
+        return list(get_pdf_transactions(path, workers, cache=cache))
     else:
         raise ValueError("Unsupported file type")
 
-    logger.info("Imported %d transactions", len(txs))
-    for tx in txs:
-        db.store_transaction(tx)
-    logger.info("Stored %d transactions successfully", len(txs))
+
+def _parse_statement_in_worker(path, layout):
+    cache = None if layout is None else _LayoutHandoff(*layout)
+    txs = parse_statement(path, 1, cache)
+    return txs, None if cache is None else cache.stored
+
+
+def _parse_result(path, future):
+    try:
+        return path, future.result()
+    except Exception as e:
+        return path, e
+
+
+class _LayoutHandoff(object):
+    # Stands in for the database's layout cache in a worker process: serves the
+    # layout looked up beforehand, and keeps a new one for the writer to store.
+    def __init__(self, key, layout):
+        self.key = key
+        self.layout = layout
+        self.stored = None
+
+    def get_layout(self, key):
+        return self.layout if key == self.key else None
+
+    def store_layout(self, key, rows):
+        self.stored = (key, rows)
+
+
+def migrate():
+    init_logging()
+    args = sys.argv[1:]
+    dry_run = '--dry-run' in args
+    db_file = [arg for arg in args if arg != '--dry-run'][0]
+    key = getpass('Password: ')
+    db = Connection(db_file, key)
+    db.connect(migrate=False)
+    if not dry_run:
+        back_up_db(db, db_file)
+    logger.info("Database '%s' is at schema version %d", db_file, db.schema_version())
+
+    migrations = db.migrate(dry_run=dry_run)
+    if len(migrations) == 0:
+        print('Database is up to date (schema version {})'.format(db.schema_version()))
+    else:
+        print('{} {} migration(s):'.format('Would apply' if dry_run else 'Applied', len(migrations)))
+        for migration in migrations:
+            print('\n'.join(migration.describe()))
+    db.close()
+
+
+def run_daemon():
+    init_logging()
+    usage = 'Usage: finance-daemon start <db file> [idle timeout in minutes] | lock <db file> | status <db file>'
+    if len(sys.argv) < 3 or sys.argv[1] not in ('start', 'lock', 'status'):
+        print(usage)
+        sys.exit(1)
+    command, db_file = sys.argv[1:3]
+
+    if command == 'status':
+        print('Daemon is {}'.format('running' if daemon.is_running(db_file) else 'not running'))
+    elif command == 'lock':
+        print('Daemon locked' if daemon.lock(db_file) else 'Daemon is not running')
+    elif daemon.is_running(db_file):
+        print('Daemon is already running')
+    else:
+        idle_timeout = int(sys.argv[3]) * 60 if len(sys.argv) > 3 else daemon.DEFAULT_IDLE_TIMEOUT
+        key = getpass('Password: ')
+        # Check the key before detaching, so that a typo is reported to the user.
+        db = Connection(db_file, key)
+        db.connect(migrate=False)
+        back_up_db(db, db_file)
+        db.migrate()
+        db.close()
+        # The child reports through the pipe once it is serving, or why it couldn't.
+        ready_fd, report_fd = os.pipe()
+        if os.fork() > 0:
+            os.close(report_fd)
+            with os.fdopen(ready_fd) as ready:
+                report = ready.read()
+            if report != 'ready':
+                print('Daemon failed to start: {}'.format(report or 'it exited without reporting'))
+                sys.exit(1)
+            print('Daemon started; it will lock after {} idle minutes'.format(idle_timeout // 60))
+            return
+
+        os.close(ready_fd)
+        os.setsid()
+        with open(os.devnull, 'r+') as devnull:
+            for stream in (sys.stdin, sys.stdout, sys.stderr):
+                os.dup2(devnull.fileno(), stream.fileno())
+        try:
+            # Connect afresh in the child: SQLite connections must not cross a fork.
+            db = Connection(db_file, key)
+            db.connect()
+            server = daemon.Daemon(db, daemon.socket_path(db_file), idle_timeout)
+        except Exception as e:
+            logger.exception("Finance daemon failed to start")
+            os.write(report_fd, str(e).encode('utf-8'))
+            os._exit(1)
+        os.write(report_fd, b'ready')
+        os.close(report_fd)
+        server.serve()
+        os._exit(0)
 
 
 if __name__ == '__main__':
@@ -16,6 +16,8 @@ setup(name='finance',
           'console_scripts': [
               'finance=finance.main:repl',
               'finance-store=finance.main:ingest_file',
+              'finance-migrate=finance.main:migrate',
+              'finance-daemon=finance.main:run_daemon',
           ]
       }
       )
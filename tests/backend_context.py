@@ -2,4 +2,4 @@ import os
 import sys
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'finance')))
 
-from backend import Connection, Filter, Transaction # noqa
+from backend import Connection, Filter, Transaction, daemon, pdf_parser # noqa
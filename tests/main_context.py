@@ -0,0 +1,6 @@
+import os
+import sys
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from finance import main # noqa
+from finance.backend import Connection, daemon, get_csv_transactions # noqa
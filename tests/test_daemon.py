@@ -0,0 +1,103 @@
+import datetime
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from .backend_context import Connection, Filter, Transaction, daemon
+
+
+class TestDaemon(unittest.TestCase):
+    def setUp(self):
+        self.runtime_dir = tempfile.mkdtemp()
+        self.old_runtime_dir = os.environ.get('XDG_RUNTIME_DIR')
+        os.environ['XDG_RUNTIME_DIR'] = self.runtime_dir
+        self.db_file = os.path.join(self.runtime_dir, 'unittest.db')
+
+        # SQLite connections belong to the thread that opened them, so the daemon's
+        # connection is opened on its serving thread.
+        ready = threading.Event()
+
+        def serve():
+            db = Connection(':memory:', 'password')
+            db.connect()
+            server = daemon.Daemon(db, daemon.socket_path(self.db_file), idle_timeout=10)
+            ready.set()
+            server.serve()
+
+        self.thread = threading.Thread(target=serve)
+        self.thread.start()
+        ready.wait()
+        self.db = daemon.RemoteConnection(self.db_file)
+        self.db.connect()
+
+    def tearDown(self):
+        daemon.lock(self.db_file)
+        self.thread.join()
+        if self.old_runtime_dir is None:
+            del os.environ['XDG_RUNTIME_DIR']
+        else:
+            os.environ['XDG_RUNTIME_DIR'] = self.old_runtime_dir
+        shutil.rmtree(self.runtime_dir)
+
+    def test_store_and_query_through_daemon(self):
+        now = datetime.datetime(2018, 1, 4, 13, 0)
+        tx = Transaction(None, now, 'Panini Paradise', 490)
+        self.db.store_transaction(tx)
+        self.assertIsNotNone(tx.tid)
+        self.assertEqual((1, 1), self.db.store_transactions([
+            Transaction(None, now, 'Panini Paradise', 490),
+            Transaction(None, now, 'Webflix', 799),
+        ]))
+
+        view = self.db.as_view()
+        self.assertEqual(2, len(view))
+        self.assertEqual(['Panini Paradise', 'Webflix'], [t.description for t in view.order_by('id')])
+        self.assertEqual(now, view.max('timestamp'))
+        self.assertEqual(1, view.filter(Filter.description('Webflix')).update_categories('Entertainment'))
+        self.assertEqual([('Entertainment', 799)], view.filter(Filter.category(('Entertainment',))).aggregate(
+            level=1, aggregates=('sum',)))
+        self.assertEqual('Panini Paradise', self.db.fetch_transaction(tx.tid).description)
+
+    def test_calls_after_daemon_has_locked_raise_daemon_error(self):
+        self.assertTrue(daemon.lock(self.db_file))
+        self.thread.join()
+        self.assertRaises(daemon.DaemonGone, lambda: len(self.db.as_view()))
+
+    def test_remote_errors_are_raised_as_themselves(self):
+        self.assertRaises(ValueError, lambda: self.db.aggregate('1', (), 9, ('sum',)))
+        self.assertEqual(0, len(self.db.as_view()))
+
+    def test_rows_are_fetched_from_daemon_in_pages(self):
+        self.db.remote_page_size = 2
+        self.db.store_transactions([Transaction(None, datetime.datetime(2018, 1, day), 'Tx', day)
+                                    for day in range(1, 8)])
+        view = self.db.as_view()
+        self.assertEqual(list(range(1, 8)), [tx.amount_pence for tx in view.order_by('timestamp')])
+        self.assertEqual([7, 6, 5], [tx.amount_pence for tx in view.order_by('amount_pence', descending=True).limit(3)])
+        self.assertEqual([[1, 2], [3, 4], [5, 6], [7]],
+                         [[tx.amount_pence for tx in batch] for batch in self.db.fetch_batches('1', (), size=2)])
+
+    def test_daemon_does_not_replace_a_live_socket(self):
+        db = Connection(':memory:', 'password')
+        self.assertRaises(daemon.DaemonError, lambda: daemon.Daemon(db, daemon.socket_path(self.db_file)))
+        self.assertTrue(daemon.is_running(self.db_file))
+
+    def test_clients_ignore_a_directory_open_to_others(self):
+        socket_dir = os.path.dirname(daemon.socket_path(self.db_file))
+        os.chmod(socket_dir, 0o755)
+        try:
+            self.assertFalse(daemon.is_running(self.db_file))
+            self.assertRaises(daemon.DaemonGone, lambda: len(self.db.as_view()))
+        finally:
+            os.chmod(socket_dir, 0o700)
+
+    def test_daemon_is_reported_running_until_locked(self):
+        self.assertTrue(daemon.is_running(self.db_file))
+        self.assertTrue(daemon.lock(self.db_file))
+        self.thread.join()
+        self.assertFalse(daemon.is_running(self.db_file))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -2,6 +2,7 @@ import datetime
 import os
 import unittest
 from contextlib import closing
+from pysqlcipher3 import dbapi2 as sqlcipher
 from .backend_context import Connection, Filter, Transaction
 
 
@@ -38,6 +39,30 @@ class TestDb(unittest.TestCase):
         finally:
             os.remove('unittest.db')
 
+    def test_backup_is_readable_with_same_key(self):
+        try:
+            with new_db('unittest.db', 'password') as db:
+                db.store_transaction(Transaction(None, datetime.datetime.now(), "Test tx", 100))
+                db.backup('unittest.db.bak')
+            with new_db('unittest.db.bak', 'password') as backup:
+                self.assertEqual(1, len(backup.as_view()))
+        finally:
+            os.remove('unittest.db')
+            os.remove('unittest.db.bak')
+
+    def test_writes_from_other_connections_invalidate_cached_results(self):
+        try:
+            with new_db('unittest.db', 'password') as a, new_db('unittest.db', 'password') as b:
+                a.store_transaction(Transaction(None, datetime.datetime(2018, 1, 4), 'Panini Paradise', 490))
+                self.assertEqual(1, len(a.as_view()))
+                b.store_transactions([Transaction(None, datetime.datetime(2018, 1, 5), 'Webflix', 799),
+                                      Transaction(None, datetime.datetime(2018, 1, 6), 'Grocer', 100)])
+                view = a.as_view()
+                self.assertEqual(3, len(view))
+                self.assertEqual(3, len(list(view)))
+        finally:
+            os.remove('unittest.db')
+
     def test_invalid_passwords_are_rejected(self):
         try:
             with new_db('unittest.db', 'password') as db:
@@ -74,6 +99,110 @@ class TestSchema(unittest.TestCase):
             stored_id = next(db.fetch_transactions("1", ())).tid
             self.assertEqual(tx.tid, stored_id)
 
+    def test_fetch_single_transaction(self):
+        with in_memory_db() as db:
+            tx = Transaction(None, datetime.datetime(2018, 1, 4), "Test tx", 100)
+            db.store_transaction(tx)
+            self.assertEqual("Test tx", db.fetch_transaction(tx.tid).description)
+            self.assertIsNone(db.fetch_transaction(tx.tid + 1))
+
+    def test_retrieved_transaction_can_be_modified_and_stored(self):
+        with in_memory_db() as db:
+            then = datetime.datetime(2018, 1, 4, 13, 0)
+            db.store_transaction(Transaction(None, then, "Test tx", 100))
+            tx = next(db.fetch_transactions("1", ()))
+            tx.category_1 = "a"
+            db.store_transaction(tx)
+            tx2 = next(db.fetch_transactions("1", ()))
+            self.assertEqual(then, tx2.timestamp)
+            self.assertEqual("a", tx2.category_1)
+            self.assertEqual(1, len(db.as_view()))
+
+    def test_bulk_store_reports_inserted_and_skipped(self):
+        with in_memory_db() as db:
+            now = datetime.datetime(2018, 1, 4, 13, 0)
+            db.store_transaction(Transaction(None, now, "Existing", 100))
+            txs = [
+                Transaction(None, now, "Existing", 100),
+                Transaction(None, now, "New", 200),
+                Transaction(None, now, "New", 200),
+                Transaction(None, now, "Other", 300),
+            ]
+            self.assertEqual((2, 2), db.store_transactions(txs))
+            self.assertEqual(3, len(db.as_view()))
+
+    def test_bulk_store_spans_chunks(self):
+        with in_memory_db() as db:
+            start = datetime.datetime(2018, 1, 1)
+            txs = [Transaction(None, start + datetime.timedelta(minutes=i), "tx", i) for i in range(25)]
+            self.assertEqual((25, 0), db.store_transactions(txs, chunk_size=7))
+            self.assertEqual((0, 25), db.store_transactions(txs, chunk_size=7))
+            self.assertEqual(25, len(db.as_view()))
+
+    def test_duplicate_transaction_is_not_stored(self):
+        with in_memory_db() as db:
+            now = datetime.datetime.now()
+            db.store_transaction(Transaction(None, now, "Test tx", 100))
+            duplicate = Transaction(None, now, "Test tx", 100)
+            db.store_transaction(duplicate)
+            self.assertIsNone(duplicate.tid)
+            self.assertTrue(db.has_transaction(duplicate))
+            self.assertEqual(1, len(db.as_view()))
+
+    def test_layout_cache_evicts_least_recently_used(self):
+        with in_memory_db() as db:
+            db.layout_cache_bytes = 10
+            db.layout_cache_touch_ns = 0
+            db.store_layout('a', '1234')
+            db.store_layout('b', '5678')
+            self.assertEqual('1234', db.get_layout('a'))
+            db.store_layout('c', '9012')
+            self.assertEqual('1234', db.get_layout('a'))
+            self.assertIsNone(db.get_layout('b'))
+            self.assertEqual('9012', db.get_layout('c'))
+
+    def test_new_database_is_fully_migrated(self):
+        with in_memory_db() as db:
+            self.assertEqual([], db.migrate(dry_run=True))
+
+    def test_pre_migration_database_is_upgraded(self):
+        try:
+            db = Connection('unittest.db', 'password')
+            db.db = sqlcipher.connect('unittest.db')
+            db._do_crypto()
+            with db._safe_cursor() as c:
+                c.execute('CREATE TABLE schema (hash TEXT)')
+                c.execute('INSERT INTO schema VALUES ("35dd181e5d0e5885955c2aa61efee931")')
+                c.execute('''CREATE TABLE transactions (id INTEGER PRIMARY KEY, timestamp TIMESTAMP,
+                             description TEXT, amount_pence INTEGER, category_1 TEXT,
+                             category_2 TEXT, category_3 TEXT, notes TEXT)''')
+                c.execute('INSERT INTO transactions VALUES (1, 0, "Legacy", 100, NULL, NULL, NULL, NULL)')
+                c.execute('INSERT INTO transactions VALUES (2, 0, "Tagged", 250, "Food", "Snack", NULL, "Note")')
+                db.db.commit()
+            db.close()
+
+            db = Connection('unittest.db', 'password')
+            db.connect(migrate=False)
+            self.assertEqual(0, db.schema_version())
+            pending = db.migrate(dry_run=True)
+            self.assertNotEqual([], pending)
+            self.assertEqual(0, db.schema_version())
+            db.close()
+
+            with new_db('unittest.db', 'password') as db:
+                self.assertEqual(pending[-1].version, db.schema_version())
+                self.assertEqual([], db.migrate())
+                legacy = next(iter(db.as_view()))
+                self.assertTrue(db.has_transaction(legacy))
+                self.assertEqual((0, 1), db.store_transactions([
+                    Transaction(None, legacy.timestamp, "Legacy", 100)]))
+                tagged = db.fetch_transaction(2)
+                self.assertEqual((2, 0, 'Tagged', 250, 'Food', 'Snack', None, 'Note'), tagged.as_row())
+                self.assertEqual([2], [tx.tid for tx in db.filter(Filter.category(('Food', 'Snack')))])
+                self.assertEqual([1], [tx.tid for tx in db.filter(Filter.merchant('legacy'))])
+        finally:
+            os.remove('unittest.db')
+
 
 class TestViews(unittest.TestCase):
     _TRANSACTIONS = [
@@ -110,6 +239,19 @@ class TestViews(unittest.TestCase):
         v = self.db.filter(Filter.description('panini'))
         self.assertEqual(2, len(v))
 
+    def test_text_search_filter(self):
+        for indexed in (True, False):
+            self.assertEqual(2, len(self.db.filter(Filter.text_search('paradise', indexed))))
+            self.assertEqual(1, len(self.db.filter(Filter.text_search('delicious', indexed))))
+            self.assertEqual(2, len(self.db.filter(Filter.text_search('co S', indexed))))
+        self.assertNotIn('transactions_fts', Filter.text_search('paradise').to_sql()[0])
+
+    def test_text_search_index_follows_updates(self):
+        tx = next(iter(self.db.filter(Filter.description('Webflix'))))
+        tx.notes = 'Annual subscription'
+        self.db.store_transaction(tx)
+        self.assertEqual([tx.tid], [t.tid for t in self.db.filter(Filter.text_search('subscr', self.db.has_fulltext_index))])
+
     def test_category_match_filter_on_category_1(self):
         v = self.db.filter(Filter.category(('Food',)))
         self.assertEqual(3, len(v))
@@ -139,6 +281,227 @@ class TestViews(unittest.TestCase):
             datetime.datetime.strptime('2018-01-04 20:01', '%Y-%m-%d %H:%M')))
         self.assertEqual(2, len(v))
 
+    def test_count_is_refreshed_after_writes(self):
+        v = self.db.filter(Filter.description('Panini'))
+        self.assertEqual(2, len(v))
+        self.db.store_transaction(Transaction(None, datetime.datetime(2018, 1, 8), 'Panini Paradise', 490))
+        self.assertEqual(3, len(v))
+
+    def test_aggregate_by_category(self):
+        v = self.db.filter(Filter.category(('Food',)))
+        self.assertEqual([
+            ('Food', 'Groceries', '', 3100, 1, 3100, 3100),
+            ('Food', 'Groceries', 'Occasion', 6249, 1, 6249, 6249),
+            ('Food', 'Snack', '', 490, 1, 490, 490),
+        ], v.aggregate())
+        self.assertEqual([('Food', 9839, 3)], v.aggregate(level=1, aggregates=('sum', 'count')))
+
+    def test_aggregate_of_empty_view(self):
+        v = self.db.filter(Filter.description('Nonexistent'))
+        self.assertEqual([], v.aggregate())
+        self.assertEqual([(None, 0)], v.aggregate(level=0, aggregates=('sum', 'count')))
+
+    def test_order_by_and_limit(self):
+        v = self.db.as_view().order_by('amount_pence', 'timestamp', descending=True).limit(2)
+        self.assertEqual([6249, 3100], [tx.amount_pence for tx in v])
+        self.assertEqual(2, len(v))
+        self.assertEqual([('Food', 9349)], v.aggregate(level=1, aggregates=('sum',)))
+
+    def test_filtering_a_limited_view_narrows_its_rows(self):
+        v = self.db.as_view().order_by('amount_pence').limit(2)
+        self.assertEqual([], list(v.filter(Filter.description('Generico'))))
+        self.assertEqual(['Panini Paradise', 'Panini Paradise'],
+                         [tx.description for tx in v.filter(Filter.description('Panini'))])
+        self.assertEqual(1, len(v.filter(Filter.category(('Food',))).limit(5)))
+
+    def test_extrema(self):
+        v = self.db.filter(Filter.description('Panini'))
+        self.assertEqual(datetime.datetime(2018, 1, 5, 13, 20), v.max('timestamp'))
+        self.assertEqual(datetime.datetime(2018, 1, 4, 13, 0), v.min('timestamp'))
+        self.assertIsNone(v.filter(Filter.untagged()).max('timestamp'))
+
+    def test_latest_transaction_uses_timestamp_index(self):
+        v = self.db.as_view().order_by('timestamp', descending=True).limit(1)
+        self.assertEqual(['2018-01-07 15:00'], [tx.timestamp.strftime('%Y-%m-%d %H:%M') for tx in v])
+        self.assertTrue(any('transactions_timestamp' in step for step in v.explain()))
+
+    def test_update_categories(self):
+        v = self.db.filter(Filter.description('Generico'))
+        self.assertEqual(2, v.update_categories('Food', 'Supermarket'))
+        self.assertEqual(2, len(self.db.filter(Filter.category(('Food', 'Supermarket')))))
+        self.assertEqual(0, len(self.db.filter(Filter.category(('Food', 'Groceries')))))
+
+    def test_iter_batches(self):
+        v = self.db.as_view().order_by('timestamp')
+        batches = list(v.iter_batches(2))
+        self.assertEqual([2, 2, 1], [len(batch) for batch in batches])
+        self.assertEqual([tx.tid for tx in v], [tx.tid for batch in batches for tx in batch])
+
+    def test_keyset_pagination(self):
+        v = self.db.as_view()
+        ordered = [tx.tid for tx in v.order_by('timestamp', 'id')]
+        first = v.page_after(None, 2)
+        self.assertEqual(ordered[:2], [tx.tid for tx in first])
+        rest = v.page_after((first[-1].epoch, first[-1].tid), 10)
+        self.assertEqual(ordered[2:], [tx.tid for tx in rest])
+        self.assertEqual(ordered[-2:], [tx.tid for tx in v.page_before(None, 2)])
+        self.assertEqual(ordered[1:3], [tx.tid for tx in v.page_before((rest[1].epoch, rest[1].tid), 2)])
+        tagged = v.filter(Filter.category(('Food',)))
+        self.assertEqual([tx.tid for tx in tagged.order_by('timestamp')][1:],
+                         [tx.tid for tx in tagged.page_after((first[0].epoch, first[0].tid), 10)])
+
+    def test_query_stats(self):
+        stats = self.db.enable_query_stats()
+        self.assertEqual(5, len([tx for tx in self.db.as_view()]))
+        self.assertEqual(5, len(self.db.as_view()))
+        self.assertEqual(2, len(stats.statements))
+        self.assertEqual([1, 1], sorted(s.calls for s in stats.statements.values()))
+        self.assertEqual([1, 5], sorted(s.rows for s in stats.statements.values()))
+        self.assertEqual(3, len(stats.report()))
+        self.db.disable_query_stats()
+        list(self.db.as_view())
+        self.assertEqual(2, len(stats.statements))
+
+    def test_query_stats_per_call_figures_only_time_execute(self):
+        s = self.db.enable_query_stats().for_statement('SELECT 1')
+        s.add_call(0.001)
+        s.add_fetch(0.009, 3)
+        self.assertAlmostEqual(0.010, s.total_time)
+        self.assertAlmostEqual(0.001, s.execute_time())
+        self.assertAlmostEqual(0.001, s.max_time)
+        self.assertAlmostEqual(0.001, s.percentile(0.95))
+
+    def test_repeated_queries_are_served_from_result_cache(self):
+        stats = self.db.enable_query_stats()
+        v = self.db.as_view().order_by('timestamp').limit(10)
+        first = [tx.tid for tx in v]
+        self.assertEqual(first, [tx.tid for tx in v])
+        self.assertEqual(self.db.aggregate('1', (), 1, ('sum',)), self.db.aggregate('1', (), 1, ('sum',)))
+        self.assertEqual([1, 1], sorted(s.calls for s in stats.statements.values()))
+        self.assertEqual(2, self.db.result_cache.hits)
+
+    def test_result_cache_is_invalidated_by_writes(self):
+        self.assertEqual(5, self.db.count_transactions('1', ()))
+        self.assertEqual([('Food', 9839)], self.db.aggregate(*Filter.category(('Food',)).to_sql(), 1, ('sum',)))
+        self.db.store_transaction(Transaction(None, datetime.datetime(2018, 1, 9), 'Grocer', 100, 'Food'))
+        self.assertEqual(6, self.db.count_transactions('1', ()))
+        self.assertEqual([('Food', 9939)], self.db.aggregate(*Filter.category(('Food',)).to_sql(), 1, ('sum',)))
+        self.db.filter(Filter.description('Grocer')).update_categories('Shopping')
+        self.assertEqual([('Food', 9839)], self.db.aggregate(*Filter.category(('Food',)).to_sql(), 1, ('sum',)))
+
+    def test_only_results_known_to_be_small_are_cached_while_streaming(self):
+        self.db.result_cache_stream_rows = 4
+        self.db.result_cache.clear()
+        [tx for tx in self.db.as_view()]
+        self.assertEqual(0, len(self.db.result_cache))
+        [tx for tx in self.db.as_view().limit(4)]
+        self.assertEqual(1, len(self.db.result_cache))
+        self.db.result_cache_stream_rows = 5
+        v = self.db.as_view()
+        self.assertEqual(5, len(v))
+        [tx for tx in v]
+        self.assertEqual(3, len(self.db.result_cache))
+
+    def test_result_cache_is_bounded_by_estimated_size(self):
+        self.db.store_transaction(Transaction(None, datetime.datetime(2018, 1, 9), 'Grocer', 100, notes='x' * 4096))
+        self.db.result_cache.clear()
+        self.db.result_cache.max_bytes = 4096
+        [tx for tx in self.db.as_view().limit(2)]
+        self.assertEqual(1, len(self.db.result_cache))
+        [tx for tx in self.db.as_view().order_by('timestamp', descending=True).limit(1)]
+        self.assertEqual(1, len(self.db.result_cache))
+        self.assertLessEqual(self.db.result_cache.size, 4096)
+
+    def test_month_view_aggregates_from_monthly_totals(self):
+        self.db.store_transaction(Transaction(None, datetime.datetime(2018, 2, 1), 'Webflix', 799,
+                                              'Entertainment', 'Movies', 'Streaming'))
+        v = self.db.as_view().month(2018, 1)
+        self.assertEqual('2018-01', v.month_key)
+        self.assertEqual(5, len(v))
+        self.assertEqual(self.db.aggregate(*v.condition.to_sql(), 2, ('sum', 'count')),
+                         v.aggregate(level=2, aggregates=('sum', 'count')))
+        self.assertEqual([('2018-01', 11128, 5), ('2018-02', 799, 1)], self.db.monthly_totals())
+
+    def test_monthly_totals_follow_updates(self):
+        self.db.filter(Filter.description('Generico')).update_categories('Shopping')
+        tx = self.db.fetch_transaction(1)
+        tx.category_1 = 'Shopping'
+        self.db.store_transaction(tx)
+        self.assertEqual([('Shopping', 9839, 3)],
+                         self.db.as_view().month(2018, 1).filter(Filter.category(('Shopping',))).aggregate(
+                             level=1, aggregates=('sum', 'count')))
+        self.assertEqual(0, self.db.rebuild_monthly_totals())
+
+    def test_rebuild_monthly_totals_repairs_drift(self):
+        with self.db._safe_cursor() as c:
+            c.execute('UPDATE monthly_totals SET total_pence = 0')
+            self.db.db.commit()
+        self.assertNotEqual(0, self.db.rebuild_monthly_totals())
+        self.assertEqual([('2018-01', 11128, 5)], self.db.monthly_totals())
+        self.assertEqual(0, self.db.rebuild_monthly_totals())
+
+    def test_overlapping_filters_are_simplified(self):
+        v = self.db.as_view().filter(Filter.date_after(datetime.datetime(2018, 1, 1)))
+        v = v.filter(Filter.date_before(datetime.datetime(2018, 1, 6)))
+        v = v.filter(Filter.date_range(datetime.datetime(2018, 1, 5), datetime.datetime(2018, 2, 1)))
+        v = v.filter(Filter.category(('Food',))).filter(Filter.category(('Food',)))
+        self.assertEqual(Filter.date_range(datetime.datetime(2018, 1, 5), datetime.datetime(2018, 1, 6))
+                         & Filter.category(('Food',)), v.condition)
+        self.assertEqual(3, len(v.condition.to_sql()[1]))
+        self.assertEqual(0, len(v))
+
+    def test_contradictory_filters_are_empty_without_querying(self):
+        stats = self.db.enable_query_stats()
+        v = self.db.filter(Filter.category(('Food',))).filter(Filter.category(('Entertainment',)))
+        self.assertEqual(0, len(v))
+        self.assertEqual([], list(v))
+        self.assertEqual(0, len(self.db.as_view().month(2018, 1).month(2018, 2)))
+        self.assertEqual(0, len(self.db.filter(Filter.untagged()).filter(Filter.category(('Food',)))))
+        self.assertEqual({}, stats.statements)
+
+    def test_month_after_wider_date_filter_uses_monthly_totals(self):
+        v = self.db.filter(Filter.date_after(datetime.datetime(2017, 6, 1))).month(2018, 1)
+        self.assertEqual('2018-01', v.month_key)
+        self.assertEqual(5, len(v))
+
+    def test_names_are_stored_once_in_lookup_tables(self):
+        with self.db._safe_cursor() as c:
+            self.assertEqual(3, c.execute('SELECT COUNT(*) FROM merchants').fetchone()[0])
+            self.assertEqual(8, c.execute('SELECT COUNT(*) FROM categories').fetchone()[0])
+        self.db.filter(Filter.description('Webflix')).update_categories('Entertainment', 'TV')
+        self.assertEqual(['TV'], [tx.category_2 for tx in self.db.filter(Filter.category(('Entertainment',)))])
+        with self.db._safe_cursor() as c:
+            self.assertEqual(9, c.execute('SELECT COUNT(*) FROM categories').fetchone()[0])
+
+    def test_merchant_filter_ignores_references(self):
+        self.db.store_transactions([
+            Transaction(None, datetime.datetime(2018, 1, 8), 'CARD PAYMENT TO WEBFLIX 1234-5678', 799),
+            Transaction(None, datetime.datetime(2018, 2, 8), 'CARD PAYMENT TO WEBFLIX *9876 08/02', 799),
+            Transaction(None, datetime.datetime(2018, 2, 9), 'CARD PAYMENT TO WEBFLIX STORE', 799),
+        ])
+        self.assertEqual(['CARD PAYMENT TO WEBFLIX 1234-5678', 'CARD PAYMENT TO WEBFLIX *9876 08/02'],
+                         [tx.description for tx in
+                          self.db.filter(Filter.merchant('Card payment to Webflix')).order_by('timestamp')])
+        self.assertEqual(['Webflix'], [tx.description for tx in self.db.filter(Filter.merchant('webflix'))])
+
+    def test_id_filter(self):
+        tid = next(iter(self.db.filter(Filter.description('Webflix')))).tid
+        v = self.db.filter(Filter.id(str(tid)))
+        self.assertEqual(['Webflix'], [tx.description for tx in v])
+
+    def test_date_filter_uses_timestamp_index(self):
+        v = self.db.as_view().filter(Filter.date_before(
+            datetime.datetime.strptime('2018-01-04 20:01', '%Y-%m-%d %H:%M')))
+        self.assertTrue(any('transactions_timestamp' in step for step in v.explain()))
+
+    def test_merchant_filters_use_merchant_index(self):
+        for v in (self.db.filter(Filter.description('Webflix')), self.db.filter(Filter.merchant('Webflix'))):
+            self.assertTrue(any('transactions_merchant' in step for step in v.explain()))
+
+    def test_category_filter_uses_category_index(self):
+        v = self.db.filter(Filter.category(('Food', 'Groceries')))
+        self.assertTrue(any('transactions_category' in step for step in v.explain()))
+
 
 def new_db(path, key):
     db = Connection(path, key)
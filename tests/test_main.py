@@ -0,0 +1,177 @@
+import os
+import shutil
+import tempfile
+import unittest
+from contextlib import closing
+from unittest import mock
+from .main_context import Connection, daemon, get_csv_transactions, main
+
+
+class FailingConnection(Connection):
+    def store_transactions(self, txs, chunk_size=None):
+        txs = list(txs)
+        if any(tx.description == 'Unstorable' for tx in txs):
+            raise ValueError('Cannot store')
+        return Connection.store_transactions(self, txs)
+
+    def get_layout(self, key):
+        raise ValueError('Cannot read layout cache')
+
+    def store_layout(self, key, rows):
+        raise ValueError('Cannot write layout cache')
+
+
+class TestIngest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.write('2018-01.csv', '04/01/2018,Panini Paradise,4.90\n05/01/2018,Webflix,7.99\n')
+        self.write('2018-02.csv', '04/02/2018,Panini Paradise,4.90\n')
+        self.write('broken.csv', '04/03/2018,Panini Paradise\n')
+        self.write('notes.txt', 'Not a statement\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def write(self, name, content):
+        with open(os.path.join(self.dir, name), 'w') as f:
+            f.write(content)
+
+    def path(self, name):
+        return os.path.join(self.dir, name)
+
+    def test_expand_statement_paths(self):
+        self.assertEqual(
+            ([self.path('2018-02.csv'), self.path('2018-01.csv'), self.path('broken.csv'), self.path('missing.csv')],
+             []),
+            main.expand_statement_paths([self.path('2018-02.csv'), self.dir, self.path('2018-0*.csv'),
+                                         self.path('missing.csv')]))
+
+    def test_globs_and_directories_without_statements_are_reported(self):
+        os.mkdir(self.path('empty'))
+        self.assertEqual(([self.path('2018-01.csv')], [self.path('2019-*.csv'), self.path('empty')]),
+                         main.expand_statement_paths([self.path('2019-*.csv'), self.path('2018-01.csv'),
+                                                      self.path('empty')]))
+
+    def test_parse_statements_in_workers_keeps_order_and_captures_errors(self):
+        paths = [self.path('2018-02.csv'), self.path('broken.csv'), self.path('missing.csv'), self.path('2018-01.csv')]
+        with closing(Connection(':memory:', 'password')) as db:
+            db.connect()
+            results = list(main.parse_statements(db, paths, 2))
+        self.assertEqual(paths, [path for path, _ in results])
+        self.assertEqual([1, 2], [len(results[i][1][0]) for i in (0, 3)])
+        self.assertIsInstance(results[1][1], ValueError)
+        self.assertIsInstance(results[2][1], FileNotFoundError)
+
+    def test_failed_write_is_reported_without_stopping_other_files(self):
+        self.write('2018-03.csv', '04/03/2018,Unstorable,1.00\n')
+        paths = [self.path('2018-01.csv'), self.path('2018-03.csv'), self.path('2018-02.csv')]
+        with closing(FailingConnection(':memory:', 'password')) as db:
+            db.connect()
+            summary = main.ingest_statements(db, paths, 2)
+            self.assertEqual(3, len(db.as_view()))
+        self.assertEqual(paths, [path for path, _ in summary])
+        self.assertEqual(['Stored', 'FAILED', 'Stored'], [outcome.split()[0].rstrip(':') for _, outcome in summary])
+
+    def test_failed_layout_lookup_only_fails_its_statement(self):
+        self.write('2018-03.pdf', 'Not actually a PDF')
+        paths = [self.path('2018-03.pdf'), self.path('2018-01.csv')]
+        with closing(FailingConnection(':memory:', 'password')) as db:
+            db.connect()
+            summary = main.ingest_statements(db, paths, 2)
+            self.assertEqual(2, len(db.as_view()))
+        self.assertEqual([(paths[0], 'FAILED: Cannot read layout cache'),
+                          (paths[1], 'Stored 2 new transactions (0 duplicates skipped)')], summary)
+
+    def test_failed_layout_cache_write_still_stores_transactions(self):
+        txs = list(get_csv_transactions(self.path('2018-01.csv')))
+        with closing(FailingConnection(':memory:', 'password')) as db:
+            db.connect()
+            with mock.patch.object(main, 'parse_statements', return_value=[('2018-01.pdf', (txs, ('key', '[]')))]):
+                summary = main.ingest_statements(db, ['2018-01.pdf'], 2)
+            self.assertEqual(2, len(db.as_view()))
+        self.assertEqual([('2018-01.pdf', 'Stored 2 new transactions (0 duplicates skipped)')], summary)
+
+
+class CopyingConnection(object):
+    def __init__(self, path, fail=False):
+        self.path = path
+        self.fail = fail
+
+    def backup(self, path):
+        with open(self.path, 'rb') as src, open(path, 'wb') as dst:
+            dst.write(src.read(4))
+            if self.fail:
+                raise OSError('Disk full')
+            dst.write(src.read())
+
+
+class TestBackup(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.db_file = os.path.join(self.dir, 'finance.db')
+        self.write(b'version 1')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def write(self, content):
+        with open(self.db_file, 'wb') as f:
+            f.write(content)
+
+    def backups(self):
+        return sorted(name for name in os.listdir(self.dir) if name.startswith('finance.db.bak'))
+
+    def read(self, name):
+        with open(os.path.join(self.dir, name), 'rb') as f:
+            return f.read()
+
+    def test_unchanged_database_is_not_backed_up_again(self):
+        main.back_up_db(CopyingConnection(self.db_file), self.db_file)
+        mtime = os.stat(self.db_file + '.bak').st_mtime_ns
+        main.back_up_db(CopyingConnection(self.db_file, fail=True), self.db_file)
+        self.assertEqual(mtime, os.stat(self.db_file + '.bak').st_mtime_ns)
+        self.assertEqual(['finance.db.bak', 'finance.db.bak.stamp'], self.backups())
+
+    def test_changed_database_rotates_backups(self):
+        for version in range(1, 6):
+            self.write('version {}'.format(version).encode('utf-8'))
+            main.back_up_db(CopyingConnection(self.db_file), self.db_file)
+        self.assertEqual(['finance.db.bak', 'finance.db.bak.1', 'finance.db.bak.2', 'finance.db.bak.stamp'],
+                         self.backups())
+        self.assertEqual(main.BACKUP_GENERATIONS, len(self.backups()) - 1)
+        self.assertEqual([b'version 5', b'version 4', b'version 3'],
+                         [self.read(name) for name in ('finance.db.bak', 'finance.db.bak.1', 'finance.db.bak.2')])
+
+    def test_failed_backup_keeps_previous_backups(self):
+        main.back_up_db(CopyingConnection(self.db_file), self.db_file)
+        self.write(b'version 2')
+        self.assertRaises(OSError, lambda: main.back_up_db(CopyingConnection(self.db_file, fail=True), self.db_file))
+        self.assertEqual(['finance.db.bak', 'finance.db.bak.stamp'], self.backups())
+        self.assertEqual(b'version 1', self.read('finance.db.bak'))
+
+
+class TestSession(unittest.TestCase):
+    def test_errors_from_commands_do_not_reopen_database(self):
+        def run_ui(db):
+            raise ValueError('Invalid category level 9')
+
+        with mock.patch.object(main, 'open_db') as open_db:
+            self.assertRaises(ValueError, lambda: main.run_session('unittest.db', None, run_ui))
+            open_db.assert_not_called()
+
+    def test_session_continues_locally_when_daemon_goes_away(self):
+        sessions = []
+
+        def run_ui(db):
+            sessions.append(db)
+            if len(sessions) == 1:
+                raise daemon.DaemonGone('Finance daemon is no longer running')
+
+        with mock.patch.object(main, 'open_db', return_value='local') as open_db:
+            main.run_session('unittest.db', 'remote', run_ui)
+            open_db.assert_called_once_with('unittest.db')
+        self.assertEqual(['remote', 'local'], sessions)
+
+
+if __name__ == '__main__':
+    unittest.main()
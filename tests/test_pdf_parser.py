@@ -0,0 +1,100 @@
+import json
+import os
+import tempfile
+import unittest
+from contextlib import closing
+from .backend_context import Connection, pdf_parser
+
+
+def write_pdf(path, pages):
+    # A minimal PDF with one line of Helvetica text per page.
+    objects = ['<< /Type /Catalog /Pages 2 0 R >>',
+               '<< /Type /Pages /Kids [{}] /Count {} >>'.format(
+                   ' '.join('{} 0 R'.format(4 + 2 * i) for i in range(len(pages))), len(pages)),
+               '<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>']
+    for i, text in enumerate(pages):
+        stream = 'BT /F1 12 Tf 72 700 Td ({}) Tj ET'.format(text)
+        objects.append('<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] /Contents {} 0 R '
+                       '/Resources << /Font << /F1 3 0 R >> >> >>'.format(5 + 2 * i))
+        objects.append('<< /Length {} >>\nstream\n{}\nendstream'.format(len(stream), stream))
+    pdf = '%PDF-1.4\n'
+    offsets = []
+    for number, obj in enumerate(objects, 1):
+        offsets.append(len(pdf))
+        pdf += '{} 0 obj\n{}\nendobj\n'.format(number, obj)
+    xref = len(pdf)
+    pdf += 'xref\n0 {}\n0000000000 65535 f \n'.format(len(objects) + 1)
+    pdf += ''.join('{:010d} 00000 n \n'.format(offset) for offset in offsets)
+    pdf += 'trailer\n<< /Size {} /Root 1 0 R >>\nstartxref\n{}\n%%EOF\n'.format(len(objects) + 1, xref)
+    with open(path, 'wb') as f:
+        f.write(pdf.encode('latin-1'))
+
+
+class TestPdfParser(unittest.TestCase):
+    def test_paginate_rows_keeps_every_row_once(self):
+        rows = [
+            (0, 700, [(10, 'Date')]),
+            (0, 650, [(10, '01 Jan 18')]),
+            (1, 700, [(10, 'Date')]),
+            (1, 650, [(10, '02 Jan 18')]),
+            (2, 700, [(10, 'Date')]),
+        ]
+        self.assertEqual([
+            [[(10, 'Date')], [(10, '01 Jan 18')]],
+            [[(10, 'Date')], [(10, '02 Jan 18')]],
+            [[(10, 'Date')]],
+        ], list(pdf_parser.paginate_rows(iter(rows))))
+
+    def test_paginate_rows_of_empty_document(self):
+        self.assertEqual([], list(pdf_parser.paginate_rows(iter([]))))
+
+    def test_cached_layout_is_used_instead_of_parsing(self):
+        rows = [(0, 700, [(10, 'Date'), (80, 'Payment type')])]
+        fd, path = tempfile.mkstemp(suffix='.pdf')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(b'Not actually a PDF')
+            with closing(Connection(':memory:', 'password')) as db:
+                db.connect()
+                db.store_layout(pdf_parser.layout_cache_key(path), json.dumps(rows))
+                self.assertEqual(rows, list(pdf_parser.get_text_rows(path, cache=db)))
+        finally:
+            os.remove(path)
+
+    def test_recently_used_layouts_are_read_without_writing(self):
+        with closing(Connection(':memory:', 'password')) as db:
+            db.connect()
+            db.store_layout('key', '[]')
+            changes = db.db.total_changes
+            self.assertEqual('[]', db.get_layout('key'))
+            self.assertEqual(changes, db.db.total_changes)
+            db.layout_cache_touch_ns = -1
+            self.assertEqual('[]', db.get_layout('key'))
+            self.assertEqual(changes + 1, db.db.total_changes)
+
+    def test_pages_without_header_are_not_laid_out(self):
+        fd, path = tempfile.mkstemp(suffix='.pdf')
+        os.close(fd)
+        try:
+            write_pdf(path, ['Terms and conditions', 'Date', 'Summary'])
+            pages = list(pdf_parser.layout_pages(path))
+            self.assertEqual([0, 1, 2], [page for page, _ in pages])
+            self.assertEqual([None, None], [pages[0][1], pages[2][1]])
+            self.assertEqual(['Date'], [text for cells in pages[1][1].values() for _, text in cells])
+            stats = pdf_parser.PageStats()
+            self.assertEqual([(1, [(72, 'Date')])],
+                             [(page, cells) for page, _, cells in pdf_parser.get_text_rows(path, 1, stats=stats)])
+            self.assertEqual((1, 2), (stats.analysed, stats.skipped))
+        finally:
+            os.remove(path)
+
+    def test_parallel_layout_matches_serial(self):
+        fd, path = tempfile.mkstemp(suffix='.pdf')
+        os.close(fd)
+        try:
+            write_pdf(path, ['Date {}'.format(i) if i % 3 else 'Notes {}'.format(i) for i in range(11)])
+            serial = list(pdf_parser.get_text_rows(path, 1))
+            self.assertEqual(7, len(serial))
+            self.assertEqual(serial, list(pdf_parser.get_text_rows(path, 3)))
+        finally:
+            os.remove(path)